@@ -11,22 +11,29 @@
 # IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
 # or implied.
 
+import hashlib
+import json
 import logging
 import os
+import random
 import re
+import sys
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
-from attrdict import AttrDict
-from git import Repo, Git, exc
 
-import urllib3
-import yaml
-from dnacentersdk import api, ApiError
-from jinja2 import Environment, FileSystemLoader, meta
+from deployment import materialize, parse_deployment_file
+from instrumentation import InstrumentedAPI
+from metadata_index import MetadataIndex
+from metrics import Metrics
+from polling import PollStats
+from utils import ordered_map, read_config, update_results_json
 
-from utils import read_config, update_results_json
+# heavy modules (dnacentersdk, git, jinja2, sqlite3, asyncio) and the modules
+# depending on them are only imported where they're used, so offline commands
+# (i.e. validate.py, render_tests.py) start fast
 
-urllib3.disable_warnings()
 logger = logging.getLogger(os.path.basename(__file__))
 
 
@@ -37,12 +44,14 @@ def _basename(path):
 
 class DNACTemplate(object):
     def __init__(self, config_file=None, project=None, connect=True):
+        start = time.time()
         # read config file
         if config_file is None:
             config_file = os.path.join(os.path.dirname(__file__), 'config.yaml')
         self.config = read_config(config_file)
 
         self.test_template_dir = os.path.join(os.path.dirname(__file__), '../tests/templates')
+        self.template_dir = os.path.join(os.path.dirname(__file__), '../dnac-templates')
 
         if not hasattr(self.config, 'show_diffs'):
             self.config.show_diffs = False
@@ -52,31 +61,306 @@ class DNACTemplate(object):
             self.config.commit_history_count = 0
         if not hasattr(self.config, 'dnac_cli_template_summary_chars'):
             self.config.dnac_cli_template_summary_chars = 300
+        if not hasattr(self.config, 'template_fetch_workers'):
+            self.config.template_fetch_workers = 1
+        if not hasattr(self.config, 'provision_workers'):
+            self.config.provision_workers = 1
+        # task/deployment polling: exponential backoff between initial and max delay
+        # until the deadline (all in seconds)
+        if not hasattr(self.config, 'poll_initial_delay'):
+            self.config.poll_initial_delay = 0.5
+        if not hasattr(self.config, 'poll_max_delay'):
+            self.config.poll_max_delay = 8
+        if not hasattr(self.config, 'task_poll_deadline'):
+            self.config.task_poll_deadline = 30
+        if not hasattr(self.config, 'deployment_poll_deadline'):
+            self.config.deployment_poll_deadline = 120
+        # additional seconds a deployment may take for each device after the first
+        if not hasattr(self.config, 'deployment_poll_deadline_per_device'):
+            self.config.deployment_poll_deadline_per_device = 0
+        # poll all outstanding tasks/deployments from one asyncio event loop
+        if not hasattr(self.config, 'async_polling'):
+            self.config.async_polling = False
+        if not hasattr(self.config, 'poll_workers'):
+            self.config.poll_workers = 8
+        if not hasattr(self.config, 'deploy_batch_size'):
+            self.config.deploy_batch_size = 1
+        # percentage of local previews cross-checked against DNAC's preview API
+        if not hasattr(self.config, 'preview_sample_percent'):
+            self.config.preview_sample_percent = 0
+        # targets previewed in parallel (the preview file is still written in order)
+        if not hasattr(self.config, 'preview_workers'):
+            self.config.preview_workers = 1
+        # on-disk cache of compiled Jinja templates
+        if not hasattr(self.config, 'jinja_cache_dir'):
+            self.config.jinja_cache_dir = None
+        # record of successful deployments used to skip unchanged targets
+        if not hasattr(self.config, 'deploy_state_db'):
+            self.config.deploy_state_db = None
+        # per template/device outcomes and API latencies are stored here
+        if not hasattr(self.config, 'results_db'):
+            self.config.results_db = None
+        # DNAC project/template listing shared between pipeline stages for up to
+        # metadata_cache_ttl seconds
+        if not hasattr(self.config, 'metadata_cache_file'):
+            self.config.metadata_cache_file = None
+        if not hasattr(self.config, 'metadata_cache_ttl'):
+            self.config.metadata_cache_ttl = 300
+        if not hasattr(self.config, 'provision_state_file'):
+            self.config.provision_state_file = '.provision-state.json'
+        # processes used to parse deployment files and their device shard files
+        if not hasattr(self.config, 'parse_workers'):
+            self.config.parse_workers = 1
+        # validate.py: processes used (0: one per CPU) and record of files validated before
+        if not hasattr(self.config, 'validate_workers'):
+            self.config.validate_workers = 0
+        if not hasattr(self.config, 'validate_cache_file'):
+            self.config.validate_cache_file = None
+        # reject targets with missing params or unknown devices before deploying
+        if not hasattr(self.config, 'preflight_check'):
+            self.config.preflight_check = False
+        # HTTP transport: connection pool size (0: largest worker count), requests
+        # per second (0: no limit) and retries of 429/5xx responses
+        if not hasattr(self.config, 'http_pool_size'):
+            self.config.http_pool_size = 0
+        if not hasattr(self.config, 'rate_limit'):
+            self.config.rate_limit = 0
+        if not hasattr(self.config, 'rate_limit_burst'):
+            self.config.rate_limit_burst = 0
+        if not hasattr(self.config, 'http_retries'):
+            self.config.http_retries = 0
+        if not hasattr(self.config, 'http_max_retry_wait'):
+            self.config.http_max_retry_wait = 60
+        # DNAC auth tokens shared between pipeline stages for up to token_cache_ttl seconds
+        if not hasattr(self.config, 'token_cache_file'):
+            self.config.token_cache_file = None
+        if not hasattr(self.config, 'token_cache_ttl'):
+            self.config.token_cache_ttl = 3000
+        # Prometheus textfile with API/git call metrics, written on close() ("{script}"
+        # is replaced by the name of the running script)
+        if not hasattr(self.config, 'metrics_file'):
+            self.config.metrics_file = None
+        # record the requests/responses exchanged with DNAC into a fixture file (written
+        # on close(), "{script}" is replaced like in metrics_file), or serve DNAC's
+        # responses from such a fixture, replay_speed times faster (0: no delays)
+        if not hasattr(self.config, 'record_file'):
+            self.config.record_file = None
+        if not hasattr(self.config, 'replay_file'):
+            self.config.replay_file = None
+        if not hasattr(self.config, 'replay_speed'):
+            self.config.replay_speed = 1
+
+        self.poll_stats = {'task': PollStats(), 'deployment': PollStats()}
+        # DNAC API and git call latencies, HTTP retries and poll wait times
+        self.metrics = Metrics()
+        # set up by setup_transport() if record_file/replay_file is configured
+        self.recorder = None
+        self.replay_adapter = None
+        # shared poller, started on first use if async_polling is configured
+        self.poller = None
+        self.init_lock = threading.Lock()
+        # populated by load_git_history()
+        self.git_history = None
+        # populated by provision_templates() or load_impact()
+        self.impact = None
+        # set by preview_templates(local=True)
+        self.local_renderer = None
+        self.preview_mismatches = 0
+        self.preview_lock = threading.Lock()
+
+        # API client, project id and repo are created on first use (see the properties below)
+        self.online = connect is not False
+        # reentrant, as resolving the project id logs in
+        self.connect_lock = threading.RLock()
+        self._dnac = None
+        self._template_project_id = None
+        self._repo = None
+        self._repo_loaded = False
+        # opened on first use, see get_run_db()
+        self.run_db = None
+        # created on first use, see get_metadata()
+        self.metadata = None
+        # parsed deployment files, see parse_deployment_file()
+        self.deployments = {}
+        # template name -> (variables, required variables), see get_template_variables()
+        self.template_variables = {}
+        self.template_project = project or self.config.get('template_project')
+        logger.info('Initialized in {:.3f}s'.format(time.time() - start))
+
+    def connect(self):
+        '''
+        allow DNAC access for an instance created with connect=False. We
+        login when the API is first used
+        '''
+        self.online = True
 
-        if connect is False:
-            return
-
-        # login to DNAC
+    @property
+    def dnac(self):
+        '''
+        the DNAC API client, logging in on first use. None if we're offline
+        (created with connect=False)
+        '''
+        if self._dnac is None and self.online:
+            with self.connect_lock:
+                if self._dnac is None:
+                    self._dnac = self._login()
+        return self._dnac
+
+    @dnac.setter
+    def dnac(self, value):
+        self._dnac = value
+
+    @property
+    def template_project_id(self):
+        '''
+        id of the template project, created if needed
+        '''
+        if self._template_project_id is None and self.online:
+            with self.connect_lock:
+                if self._template_project_id is None:
+                    self._template_project_id = self.get_project_id(self.template_project)
+        return self._template_project_id
+
+    @template_project_id.setter
+    def template_project_id(self, value):
+        self._template_project_id = value
+
+    @property
+    def repo(self):
+        '''
+        git command wrapper of the local clone, None if it can't be loaded
+        '''
+        if not self._repo_loaded:
+            with self.connect_lock:
+                if not self._repo_loaded:
+                    self._repo = self._load_repo()
+                    self._repo_loaded = True
+        return self._repo
+
+    @repo.setter
+    def repo(self, value):
+        self._repo = value
+        self._repo_loaded = True
+
+    def _login(self):
+        from dnacentersdk import ApiError
+        import urllib3
+        from token_cache import CachingDNACenterAPI, TokenCache
+
+        urllib3.disable_warnings()
         if self.config.dnac.version != '2.2.3.3':
             logger.warn('This class has been tested with DNAC 2.2.3.3, please expect some issues with earlier releases')
+        start = time.time()
         try:
-            self.dnac = api.DNACenterAPI(**self.config.dnac)
+            token_cache = None
+            if self.config.replay_file:
+                from replay import ReplayTokens
+                token_cache = ReplayTokens()
+            elif self.config.token_cache_file:
+                token_cache = TokenCache(self.config.token_cache_file, ttl=float(self.config.token_cache_ttl))
+            sdk = CachingDNACenterAPI(token_cache=token_cache, **self.config.dnac)
         except ApiError:
             logger.fatal('Can\'t connect to DNAC, please check the configuration: {}'.format(
                 self.config.dnac))
             raise
-        # get project id, create project if needed
-        self.template_project = project or self.config.template_project
-        self.template_project_id = self.get_project_id(self.template_project)
+        self.setup_transport(sdk)
+        logger.info('Connected to DNAC in {:.2f}s'.format(time.time() - start))
+        return InstrumentedAPI(sdk, self._record_api_call)
 
-        # get reference to local git clone repo
+    def _load_repo(self):
+        from git import Git, exc
+
+        repo_path = self.config.git_root
         try:
-            repo_path = self.config.git_root
-            self.repo = Git(repo_path)
-            logger.info('Repo at {} successfully loaded.'.format(repo_path))
+            repo = Git(repo_path)
         except exc.GitError as e:
-            logger.warn('Could not load repository at {} file {}:'.format(repo_path))
-            self.repo=None
+            logger.warn('Could not load repository at {}: {}'.format(repo_path, e))
+            return None
+        logger.info('Repo at {} successfully loaded.'.format(repo_path))
+        return InstrumentedAPI(repo, self._record_git_call)
+
+    def setup_transport(self, sdk):
+        '''
+        replaces the HTTP transport of the SDK's session by a DNACAdapter
+        configured in config.yaml
+        '''
+        from transport import DNACAdapter, mount_adapter
+
+        session = getattr(getattr(sdk, '_session', None), '_req_session', None)
+        if session is None:
+            logger.warning('Can\'t find the SDK\'s HTTP session, using its default transport')
+            return
+        pool_size = int(self.config.http_pool_size) or max(
+            10, int(self.config.template_fetch_workers), int(self.config.provision_workers),
+            int(self.config.poll_workers), int(self.config.preview_workers))
+        kwargs = dict(
+            pool_size=pool_size,
+            rate_limit=float(self.config.rate_limit),
+            burst=float(self.config.rate_limit_burst),
+            retries=int(self.config.http_retries),
+            max_retry_wait=float(self.config.http_max_retry_wait),
+            metrics=self.metrics)
+        if self.config.replay_file:
+            from replay import ReplayAdapter, load_fixture
+
+            speed = float(self.config.replay_speed)
+            # the rate limit is sped up like everything else
+            kwargs['rate_limit'] = kwargs['rate_limit'] * speed if speed > 0 else 0
+            self.replay_adapter = ReplayAdapter(load_fixture(self.config.replay_file), speed=speed, **kwargs)
+            mount_adapter(session, self.replay_adapter)
+            logger.info('Replaying DNAC responses from {} at {}x speed'.format(
+                self.config.replay_file, speed if speed > 0 else 'maximum'))
+            return
+        if self.config.record_file:
+            from replay import Recorder
+
+            self.recorder = Recorder()
+            kwargs['recorder'] = self.recorder
+        mount_adapter(session, DNACAdapter(**kwargs))
+        logger.debug('HTTP pool size {}, rate limit {}/s, {} retries'.format(
+            pool_size, self.config.rate_limit or 'no', self.config.http_retries))
+
+    def get_run_db(self):
+        '''
+        returns the RunDatabase if results_db is configured, otherwise None
+        '''
+        from run_db import RunDatabase
+
+        if self.run_db is None and self.config.results_db:
+            with self.init_lock:
+                if self.run_db is None:
+                    self.run_db = RunDatabase(self.config.results_db)
+        return self.run_db
+
+    def get_metadata(self):
+        '''
+        returns the MetadataIndex of DNAC projects and templates
+        '''
+        if self.metadata is None:
+            # login before taking init_lock, see connect_lock
+            dnac = self.dnac
+            with self.init_lock:
+                if self.metadata is None:
+                    self.metadata = MetadataIndex(
+                        dnac,
+                        cache_file=self.config.metadata_cache_file,
+                        ttl=float(self.config.metadata_cache_ttl),
+                        key='{}|{}'.format(self.config.dnac.get('base_url'), self.config.dnac.get('username')))
+        return self.metadata
+
+    def _record_api_call(self, method, duration, ok):
+        self.metrics.observe('api', method, duration, ok)
+        if self.get_run_db() is not None:
+            self.run_db.record_api_call(method, duration, ok)
+
+    def _record_git_call(self, method, duration, ok):
+        self.metrics.observe('git', method, duration, ok)
+        if self.get_run_db() is not None:
+            self.run_db.record_api_call('git.' + method, duration, ok)
+
+    def _record_item(self, stage, kind, name, outcome, duration=None, detail=None):
+        if self.get_run_db() is not None:
+            self.run_db.record_item(stage, kind, name, outcome, duration, detail)
 
     def get_commit_log(self, filename, commits_count=5):
         '''
@@ -85,7 +369,9 @@ class DNACTemplate(object):
         return empty string if local git repo is not initialized
         '''
         commit_log = ""
-        if self.repo is not None and commits_count > 0:
+        if self.git_history is not None and self.git_history.covers(filename):
+            commit_log = self.git_history.get_commit_log(filename, commits_count)
+        elif self.repo is not None and commits_count > 0:
             commit_log = (self.repo.log('--pretty=format:"%ad | %s %d [%an]"', 
                                     '-{}'.format(commits_count),
                                     '--date=short',
@@ -104,16 +390,39 @@ class DNACTemplate(object):
 
         diff_comments = ""
 
-        if self.repo is not None:
+        if self.git_history is not None and self.git_history.covers(filename):
+            file_diff = self.git_history.get_file_diff(filename)
+        elif self.repo is not None:
             file_diff = self.repo.log('--pretty=%H','-p','-1', filename)
+        else:
+            file_diff = ''
 
-            for l in file_diff.splitlines():
-                if len(l):
-                    diff_comments += template_comments.format(l)
+        for l in file_diff.splitlines():
+            if len(l):
+                diff_comments += template_comments.format(l)
 
         return diff_comments
 
 
+    def load_git_history(self, template_dir):
+        '''
+        retrieve commit logs and diffs for all files in template_dir in one go,
+        so get_commit_log() and get_file_diff() don't need to call git per file
+        '''
+        from git import exc
+        from git_history import GitHistoryIndex
+
+        commits_count = int(self.config.commit_history_count)
+        if self.repo is None or (commits_count <= 0 and not self.config.show_diffs):
+            return
+        try:
+            self.git_history = GitHistoryIndex(self.repo, template_dir,
+                                               commits_count=commits_count,
+                                               with_diffs=self.config.show_diffs)
+        except exc.GitCommandError as e:
+            logger.warning('Could not load git history for {}: {}'.format(template_dir, e))
+            self.git_history = None
+
     def get_project_id(self, project):
         '''
         Retrieve the project ID as we need it in various places. If
@@ -122,11 +431,12 @@ class DNACTemplate(object):
         if not project:
             raise ValueError('DNAC project name not provided in config.yaml')
 
-        for p in self.dnac.configuration_templates.get_projects():
-            if p.name == project:
-                return p.id
+        project_id = self.get_metadata().project_id(project)
+        if project_id:
+            return project_id
 
         task = self.dnac.configuration_templates.create_project(name=project)
+        self.get_metadata().invalidate()
         (project_id, data) = self.wait_and_check_status(task)
         if project_id:
             logger.info('Created project "{}"'.format(project))
@@ -134,36 +444,55 @@ class DNACTemplate(object):
         else:
             raise Exception('Creation of project "{}" failed: {}'.format(project, data))
 
-    def retrieve_provisioned_templates(self, template_name=None):
+    def retrieve_provisioned_templates(self, template_names=None):
         '''
         retrieve a list of templates currently provisioned.
         Returns a dict of template detail dicts, indexed by name
+        If template_names is given, details are only retrieved for these
+        templates, all others are returned without details
         '''
         logger.debug('Retrieving existing templates')
+        start = time.time()
+        templates = list(self.dnac.configuration_templates.gets_the_templates_available(
+            project_id=self.template_project_id,
+            filter_conflicting_templates=True))
+
+        def _fetch_details(t):
+            if template_names is not None and t.name not in template_names:
+                return {}
+            return self.dnac.configuration_templates.get_template_details(t.templateId)
+
+        # fetching details is one API call per template, so use a bounded
+        # worker pool if configured
+        workers = max(1, int(self.config.template_fetch_workers))
+        if workers > 1 and len(templates) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                details = list(executor.map(_fetch_details, templates))
+        else:
+            details = [_fetch_details(t) for t in templates]
+
         result = {}
-        for t in self.dnac.configuration_templates.gets_the_templates_available(
-                project_id=self.template_project_id,
-                filter_conflicting_templates=True):
+        for t, d in zip(templates, details):
             # store both template and template details, joining both in the same dict
             result[t.name] = t
-            result[t.name].update(self.dnac.configuration_templates.get_template_details(t.templateId))
+            result[t.name].update(d)
             # logger.debug('Retrieved template {}, full info: {}'.format(t.templateId, result[t.name]))
+        logger.info('Retrieved {} templates ({} with details) in {:.2f}s using {} worker(s)'.format(
+            len(result), len([d for d in details if d]), time.time() - start, workers))
         return result
 
     def retrieve_template_id_by_name(self, template_name):
         '''
         Retrieves template by name in selected project
         '''
-        for t in self.dnac.configuration_templates.gets_the_templates_available(
-                project_id=self.template_project_id):
-            if t.name == template_name:
-                return t.templateId
-        return None
+        return self.get_metadata().template_id(self.template_project_id, template_name)
 
     def get_template_params(self, content, language, template_dir):
         '''
         extracts referenced jinja2 variables and returns params list.
         '''
+        from template_cache import find_undeclared_variables, get_environment
+
         # TODO: This is not robust, we assume all variables found are strings,
         # we don't look for vars in Jinja control statements or loops
         # as we don't seem to need this stored in the templates, just return
@@ -171,9 +500,7 @@ class DNACTemplate(object):
 
         # return []
         if language == 'JINJA':
-            env = Environment(loader=FileSystemLoader(template_dir))
-            parsed_content = env.parse(content)
-            variables = meta.find_undeclared_variables(parsed_content)
+            variables = find_undeclared_variables(content, get_environment(template_dir))
         else:
             variables = re.findall(r'\${*([a-z][a-z0-9_]+)}*', content, re.I)
         params = []
@@ -191,7 +518,7 @@ class DNACTemplate(object):
 
         return params
 
-    def wait_and_check_status(self, response, max_attempts=2, sleeptime=2):
+    def wait_and_check_status(self, response, deadline=None):
         '''
         poll status of task (i.e. template creation or update), and return
         response.data
@@ -199,24 +526,126 @@ class DNACTemplate(object):
         def _is_scalar(val):
             return not isinstance(val, (list, tuple, dict, type(None)))
 
-        attempt = 0
-        result = None
-        while attempt < max_attempts:
-            time.sleep(sleeptime)
-            status = self.dnac.task.get_task_by_id(response['response']['taskId'])
-            logger.debug('Check task {task}, attempt {attempt}, response: {response}'.format(
-                task=response['response']['taskId'],
-                attempt=attempt,
+        task_id = response['response']['taskId']
+
+        def _check():
+            status = self.dnac.task.get_task_by_id(task_id)
+            logger.debug('Check task {task}, response: {response}'.format(
+                task=task_id,
                 response=status.response
             ))
             # check for response as well as data type of data, which should be a scalar on success - sic
-            if status.response.isError is False and _is_scalar(status.response.data):
-                result = status.response.data
-                break
-            attempt += 1
-            logger.debug('waiting, response was {}'.format(status.response))
+            return (status.response.isError is False and _is_scalar(status.response.data), status)
 
-        return (result, status.response.data)
+        (done, status) = self.submit_poll(_check, 'task', deadline).result()
+        if not done:
+            logger.debug('giving up on task {}, response was {}'.format(task_id, status.response))
+
+        return (status.response.data if done else None, status.response.data)
+
+    def submit_poll(self, check, kind, deadline=None):
+        '''
+        poll check() (see polling.poll) for a task or deployment (kind).
+        Returns a future resolving to (done, value). If async_polling is
+        configured, all outstanding polls are multiplexed on a shared AsyncPoller,
+        otherwise we poll right away and return a completed future.
+        '''
+        from polling import AsyncPoller, poll
+
+        deadline = deadline or float(self.config['{}_poll_deadline'.format(kind)])
+        initial_delay = float(self.config.poll_initial_delay)
+        max_delay = float(self.config.poll_max_delay)
+        if self.config.replay_file:
+            # polls are sped up like the replayed responses
+            speed = float(self.config.replay_speed)
+            initial_delay = initial_delay / speed if speed > 0 else 0
+            max_delay = max_delay / speed if speed > 0 else 0
+            deadline = deadline / speed if speed > 0 else deadline
+        if self.config.async_polling:
+            if self.poller is None:
+                with self.init_lock:
+                    if self.poller is None:
+                        self.poller = AsyncPoller(initial_delay=initial_delay,
+                                                  max_delay=max_delay,
+                                                  workers=int(self.config.poll_workers))
+            return self.poller.submit(check, deadline=deadline, stats=self.poll_stats[kind])
+
+        future = Future()
+        future.set_result(poll(check,
+                               deadline=deadline,
+                               initial_delay=initial_delay,
+                               max_delay=max_delay,
+                               stats=self.poll_stats[kind]))
+        return future
+
+    def close(self):
+        '''
+        stop the background poller (if any), write the metrics file (if
+        configured) and close the results database
+        '''
+        if self.poller is not None:
+            self.poller.close()
+            self.poller = None
+        if self.config.metrics_file:
+            self.write_metrics(self.config.metrics_file)
+        if self.recorder is not None:
+            filename = self._script_file(self.config.record_file)
+            count = self.recorder.save(filename, base_url=self.config.dnac.get('base_url'))
+            logger.info('Recorded {} DNAC requests to {}'.format(count, filename))
+            self.recorder = None
+        if self.replay_adapter is not None:
+            logger.info('Replay done, {} requests without recorded response, {} recorded responses not used'.format(
+                self.replay_adapter.misses, self.replay_adapter.unused()))
+            self.replay_adapter = None
+        if self.run_db is not None:
+            self.run_db.close()
+            self.run_db = None
+
+    def submit_deployment(self, deployment_id, deadline=None):
+        '''
+        poll status of a template deployment until it is no longer in progress.
+        Returns a future resolving to (done, last deployment status)
+        '''
+        def _check():
+            results = self.dnac.configuration_templates.get_template_deployment_status(
+                deployment_id=deployment_id)
+            logger.debug('deployment status: {}'.format(results))
+            return (results.status not in ('IN_PROGRESS', 'INIT'), results)
+
+        return self.submit_poll(_check, 'deployment', deadline)
+
+    def _script_file(self, filename):
+        '''
+        replaces "{script}" in filename by the name of the running script
+        '''
+        script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0]
+        return filename.replace('{script}', script)
+
+    def get_metrics(self):
+        '''
+        returns the Metrics, updated with the poll statistics
+        '''
+        for kind, stats in self.poll_stats.items():
+            summary = stats.summary()
+            self.metrics.set('polls_total', summary['checks'], kind=kind)
+            self.metrics.set('poll_sleep_seconds_total', summary['sleep'], kind=kind)
+        return self.metrics
+
+    def write_metrics(self, metrics_file):
+        '''
+        write the metrics as Prometheus textfile, "{script}" in metrics_file is
+        replaced by the name of the running script
+        '''
+        filename = self._script_file(metrics_file)
+        logger.info('Writing metrics to {}'.format(filename))
+        self.get_metrics().write_textfile(filename)
+
+    def log_poll_stats(self):
+        for k, v in self.poll_stats.items():
+            summary = v.summary()
+            if summary['completed'] or summary['timeouts']:
+                logger.info('{} completion latency (s): {}'.format(
+                    k, ', '.join('{}: {}'.format(k1, v1) for k1, v1 in summary.items())))
 
     def get_template_langauge(self, content):
         '''
@@ -234,12 +663,234 @@ class DNACTemplate(object):
         else:
             return 'VELOCITY'
 
-    def provision_templates(self, template_dir, purge=True, result_json=None):
+    def _provision_template(self, template_dir, template_file, current_template):
+        '''
+        create or update a single template on DNAC (and version it).
+        current_template is the provisioned template detail dict, or None
+        if the template doesn't exist yet.
+        Returns 'created', 'updated', 'skipped' or 'errors'
+        '''
+        from dnacentersdk import ApiError
+
+        logger.debug('processing file "{}"'.format(template_file))
+        with open(os.path.join(template_dir, template_file), 'r') as fd:
+            template_content = fd.read()
+            language = self.get_template_langauge(template_content)
+
+            commit_log = self.get_commit_log(filename=os.path.join(template_dir, template_file),
+                                             commits_count=int(self.config.commit_history_count))
+
+            if self.config.show_diffs:
+                template_diff = self.get_file_diff(filename=os.path.join(template_dir, template_file),
+                                                   language = language)
+            else:
+                template_diff = ''
+            # DNAC requires includes to include the absolute path, so we make this
+            # dependent on the project (i.e. {% include "__PROJECT__/foo" %} )
+            template_content = '{}{}'.format(template_diff,
+                               re.sub('__PROJECT__', self.template_project, template_content))
+
+        template_name = template_file
+
+        if not current_template:
+            # new template
+            params = {
+                'project_id': self.template_project_id,
+                'name': template_name,
+                'description': '',
+                'containingTemplates': [],
+                'language': language,
+                'composite': False,
+                'deviceTypes': [{'productFamily': 'Routers'}, 
+                                {'productFamily': 'Switches and Hubs'},
+                                {'productFamily': 'Wireless Controller'},],
+                'softwareType': "IOS-XE",
+                'softwareVersion': None,
+                'tags': [],
+                'templateParams': self.get_template_params(template_content, language, template_dir),
+                'templateContent': template_content
+            }
+            # create the template
+            logger.info('Creating template "{}"'.format(template_name))
+            logger.debug(params)
+            try:
+                response = self.dnac.configuration_templates.create_template(**params)
+            except ApiError as e:
+                logger.error(str(e))
+                return 'errors'
+            outcome = 'created'
+        else:
+            # check if content changed
+            if template_content == current_template.templateContent:
+                logger.info('No change in template "{}", no update needed'.format(template_name))
+                return 'skipped'
+
+            params = {
+                'id': current_template.id,
+                'projectId': self.template_project_id,
+                'name': template_name,
+                'language': language,
+                'composite': current_template.composite,
+                'softwareType': current_template.softwareType,
+                'deviceTypes': current_template.deviceTypes,
+                'templateParams': self.get_template_params(template_content, language, template_dir),
+                'templateContent': template_content
+            }
+            logger.info('Updating template "{}"'.format(template_name))
+            logger.debug(params)
+            try:
+                response = self.dnac.configuration_templates.update_template(current_template.id, **params)
+            except ApiError as e:
+                logger.error(str(e))
+                return 'errors'
+            outcome = 'updated'
+
+        self.get_metadata().invalidate()
+
+        # check task and retrieve the template_id
+        (template_id, data) = self.wait_and_check_status(response)
+        if not template_id:
+            raise Exception('Creation of template "{}" failed: {}'.format(template_name, data))
+
+        # Template comments length is limited to fixed number of characters
+        comments = (('committed by gitlab-ci at {} UTC\n').format(datetime.utcnow()) + \
+                     commit_log)
+        comments = comments[:self.config.dnac_cli_template_summary_chars]
+
+        # Commit the template
+        response = self.dnac.configuration_templates.version_template(
+            templateId=template_id,
+            comments=comments)
+        self.wait_and_check_status(response)
+        self.get_metadata().invalidate()
+
+        return outcome
+
+    def _provision_template_timed(self, template_dir, template_file, current_template):
+        '''
+        returns (outcome, duration) of _provision_template()
+        '''
+        start = time.time()
+        outcome = self._provision_template(template_dir, template_file, current_template)
+        return (outcome, time.time() - start)
+
+    def _provision_all(self, template_dir, template_files, provisioned_templates, graph):
+        '''
+        run _provision_template() for all template files, using a pool of
+        provision_workers threads so the create/update, task polling and versioning
+        of different templates overlap. A template is only started once the
+        templates it includes have been provisioned.
+        Yields (template_file, (outcome, duration)) tuples as templates complete
+        '''
+        template_files = graph.ordered(template_files)
+        workers = max(1, int(self.config.provision_workers))
+        if workers == 1 or len(template_files) < 2:
+            for template_file in template_files:
+                yield (template_file, self._provision_template_timed(
+                    template_dir, template_file, provisioned_templates.get(template_file)))
+            return
+
+        logger.info('Provisioning {} templates using {} workers'.format(len(template_files), workers))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = {}
+        waiting = list(template_files)
+        pending = set(template_files)
+        try:
+            while waiting or futures:
+                ready = [t for t in waiting if not (graph.dependencies(t) & (pending - {t}))]
+                if not ready and not futures:
+                    # include loop, nothing we can do but go ahead
+                    ready = waiting[:1]
+                for template_file in ready:
+                    waiting.remove(template_file)
+                    future = executor.submit(self._provision_template_timed, template_dir, template_file,
+                                             provisioned_templates.get(template_file))
+                    futures[future] = template_file
+
+                finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    template_file = futures.pop(future)
+                    pending.discard(template_file)
+                    # re-raises a failed template task just like the serial loop
+                    yield (template_file, future.result())
+        finally:
+            # don't start any new templates if we bail out
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _delete_template(self, template):
+        logger.info('deleting template "{}"'.format(template.name))
+        try:
+            self.dnac.configuration_templates.deletes_the_template(template.id)
+        except AttributeError:
+            self.dnac.configuration_templates.delete_template(template.id)
+        self.get_metadata().invalidate()
+
+    def read_provision_state(self):
+        '''
+        returns the commit recorded by the last successful provisioning run
+        for our project, or None if no (usable) state is found
+        '''
+        try:
+            with open(self.config.provision_state_file) as fd:
+                state = json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return None
+        if state.get('project') != self.template_project:
+            return None
+        return state.get('commit')
+
+    def write_provision_state(self, commit):
+        with open(self.config.provision_state_file, 'w') as fd:
+            fd.write(json.dumps({'project': self.template_project, 'commit': commit}, indent=2) + '\n')
+
+    def get_changed_templates(self, template_dir, since_commit):
+        '''
+        use git diff to find template files changed between since_commit and HEAD.
+        Returns a tuple of (changed, deleted) template names, or None if
+        the diff can't be computed (i.e. commit no longer in history)
+        '''
+        from git import exc
+
+        if self.repo is None or not since_commit:
+            return None
+        try:
+            diff = self.repo.diff('--name-status', '--no-renames', since_commit, 'HEAD', '--', template_dir)
+        except exc.GitCommandError as e:
+            logger.warning('Can\'t compute diff since commit {}: {}'.format(since_commit, e))
+            return None
+
+        changed = []
+        deleted = []
+        for line in diff.splitlines():
+            if not line.strip():
+                continue
+            status, path = line.split('\t', 1)
+            template_file = os.path.basename(path)
+            if template_file.startswith('.') or 'README.md' in template_file:
+                continue
+            if status.startswith('D'):
+                deleted.append(template_file)
+            else:
+                changed.append(template_file)
+        return (changed, deleted)
+
+    def provision_templates(self, template_dir, purge=True, result_json=None, incremental=False,
+                            impact_file=None):
         '''
         Push all templates found in our git repo to DNAC
         TODL Templates which have previously provisioned but which have been removed
         on git are also removed from DNAC
+        If incremental is True, only push templates changed since the last
+        successful run (as recorded in provision_state_file), falling back to a
+        full run if no usable state is found
+        The templates affected by this run (changed templates and the templates
+        including them) are stored in self.impact and written to impact_file
         '''
+        from git import exc
+        from template_deps import TemplateGraph
+
         results = {
             'created': 0,
             'updated': 0,
@@ -248,206 +899,213 @@ class DNACTemplate(object):
             'errors': 0,
         }
 
-        # first remember which customers are currently provisioned so we can
-        # handle deletion of the whole customer file
-        provisioned_templates = self.retrieve_provisioned_templates()
+        head_commit = None
+        last_commit = None
+        changes = None
+        if self.repo is not None:
+            try:
+                head_commit = self.repo.rev_parse('HEAD')
+            except exc.GitCommandError:
+                logger.warning('Can\'t determine HEAD commit, not tracking provisioning state')
+        if incremental and head_commit:
+            last_commit = self.read_provision_state()
+            changes = self.get_changed_templates(template_dir, last_commit)
+            if changes is None:
+                logger.info('No usable provisioning state found, provisioning all templates')
+            else:
+                logger.info('Provisioning templates changed since commit {}'.format(last_commit))
+
+        if changes is not None:
+            (changed, deleted) = changes
+            # only fetch details for templates which changed
+            provisioned_templates = self.retrieve_provisioned_templates(template_names=changed + deleted)
+            template_files = [t for t in changed if os.path.exists(os.path.join(template_dir, t))]
+            to_delete = [provisioned_templates[t] for t in deleted if t in provisioned_templates]
+            results['skipped'] = len(provisioned_templates) - len(
+                [t for t in changed + deleted if t in provisioned_templates])
+        else:
+            # first remember which customers are currently provisioned so we can
+            # handle deletion of the whole customer file
+            provisioned_templates = self.retrieve_provisioned_templates()
+            template_files = [t for t in os.listdir(template_dir)
+                              if not t.startswith('.') and 'README.md' not in t]
+            to_delete = None
+
+        graph = TemplateGraph.from_dir(template_dir, self.get_template_langauge)
+        if changes is not None:
+            affected = graph.affected(changes[0] + changes[1])
+            logger.info('Templates affected by this change: {}'.format(', '.join(sorted(affected)) or 'none'))
+            self.impact = {'since': last_commit, 'templates': sorted(affected)}
+        else:
+            self.impact = {'since': None, 'templates': sorted(template_files)}
+        if impact_file:
+            logger.info('Writing affected templates to {}'.format(impact_file))
+            with open(impact_file, 'w') as fd:
+                fd.write(json.dumps(self.impact, indent=2) + '\n')
+
         if len(provisioned_templates) > 0:
             logger.debug('provisioned templates: {}'.format(', '.join(provisioned_templates.keys())))
         else:
             logger.debug('no templates provisioned.')
 
         pushed_templates = []
+        self.load_git_history(template_dir)
 
         # process all the templates found in the repo
-        for template_file in os.listdir(template_dir):
-            if template_file.startswith('.') or 'README.md' in template_file:
-                continue
-
-            logger.debug('processing file "{}"'.format(template_file))
-            with open(os.path.join(template_dir, template_file), 'r') as fd:
-                template_content = fd.read()
-                language = self.get_template_langauge(template_content)
-
-                commit_log = self.get_commit_log(filename=os.path.join(template_dir, template_file),
-                                                 commits_count=int(self.config.commit_history_count))
-
-                if self.config.show_diffs:
-                    template_diff = self.get_file_diff(filename=os.path.join(template_dir, template_file),
-                                                       language = language)
-                else:
-                    template_diff = ''
-                # DNAC requires includes to include the absolute path, so we make this
-                # dependent on the project (i.e. {% include "__PROJECT__/foo" %} )
-                template_content = '{}{}'.format(template_diff,
-                                   re.sub('__PROJECT__', self.template_project, template_content))
-
-            template_name = template_file
-            
-            current_template = provisioned_templates.get(template_name)
-            if not current_template:
-                # new template
-                params = {
-                    'project_id': self.template_project_id,
-                    'name': template_name,
-                    'description': '',
-                    'containingTemplates': [],
-                    'language': language,
-                    'composite': False,
-                    'deviceTypes': [{'productFamily': 'Routers'}, 
-                                    {'productFamily': 'Switches and Hubs'},
-                                    {'productFamily': 'Wireless Controller'},],
-                    'softwareType': "IOS-XE",
-                    'softwareVersion': None,
-                    'tags': [],
-                    'templateParams': self.get_template_params(template_content, language, template_dir),
-                    'templateContent': template_content
-                }
-                # create the template
-                logger.info('Creating template "{}"'.format(template_name))
-                logger.debug(params)
-                try:
-                    response = self.dnac.configuration_templates.create_template(**params)
-                except ApiError as e:
-                    logger.error(str(e))
-                    results['errors'] += 1
-                    continue
-                else:
-                    results['created'] += 1
-            else:
-                # check if content changed
-                if template_content == current_template.templateContent:
-                    logger.info('No change in template "{}", no update needed'.format(template_name))
-                    # mark it so we don't delete it at the end
-                    pushed_templates.append(template_name)
-                    results['skipped'] += 1
-                    continue
-
-                params = {
-                    'id': current_template.id,
-                    'projectId': self.template_project_id,
-                    'name': template_name,
-                    'language': language,
-                    'composite': current_template.composite,
-                    'softwareType': current_template.softwareType,
-                    'deviceTypes': current_template.deviceTypes,
-                    'templateParams': self.get_template_params(template_content, language, template_dir),
-                    'templateContent': template_content
-                }
-                logger.info('Updating template "{}"'.format(template_name))
-                logger.debug(params)
-                try:
-                    response = self.dnac.configuration_templates.update_template(current_template.id, **params)
-                except ApiError as e:
-                    logger.error(str(e))
-                    results['errors'] += 1
-                    continue
-                else:
-                    results['updated'] += 1
-
-            # check task and retrieve the template_id
-            (template_id, data) = self.wait_and_check_status(response)
-            if not template_id:
-                raise Exception('Creation of template "{}" failed: {}'.format(template_name, data))
-
-            # Template comments length is limited to fixed number of characters
-            comments = (('committed by gitlab-ci at {} UTC\n').format(datetime.utcnow()) + \
-                         commit_log)
-            comments = comments[:self.config.dnac_cli_template_summary_chars]
-
-            # Commit the template
-            response = self.dnac.configuration_templates.version_template(
-                templateId=template_id,
-                comments=comments)
-            self.wait_and_check_status(response)
-
-            pushed_templates.append(template_name)
+        for template_file, (outcome, duration) in self._provision_all(template_dir, template_files,
+                                                                      provisioned_templates, graph):
+            results[outcome] += 1
+            self._record_item('provision', 'template', template_file, outcome, duration)
+            if outcome != 'errors':
+                # mark it so we don't delete it at the end
+                pushed_templates.append(template_file)
 
         # now that we processed all templates, check if there are any
         # templates left on DNAC, which we will delete
-        for k, v in provisioned_templates.items():
-            if k not in pushed_templates:
-                if purge is True:
-                    logger.info('deleting template "{}"'.format(k))
-                    try:
-                        self.dnac.configuration_templates.deletes_the_template(v.id)
-                    except AttributeError:
-                        self.dnac.configuration_templates.delete_template(v.id)
-
-                    results['deleted'] += 1
-                else:
-                    logger.info('Not attempting to purge template "{}"'.format(k))
+        if to_delete is None:
+            to_delete = [v for k, v in provisioned_templates.items() if k not in pushed_templates]
+        for v in to_delete:
+            if purge is True:
+                start = time.time()
+                self._delete_template(v)
+                results['deleted'] += 1
+                self._record_item('provision', 'template', v.name, 'deleted', time.time() - start)
+            else:
+                logger.info('Not attempting to purge template "{}"'.format(v.name))
+
+        self.log_poll_stats()
+
+        if head_commit and results['errors'] == 0:
+            self.write_provision_state(head_commit)
 
         if result_json:
             logger.info('Writing results to {}'.format(result_json))
             update_results_json(
                 filename=result_json,
                 message='Template provisioning run',
-                stats=results)
+                stats=results,
+                db=self.get_run_db())
+            update_results_json(
+                filename=result_json,
+                message='Provisioning API and git calls',
+                stats=self.get_metrics().summary(),
+                db=self.get_run_db())
 
         return results['errors'] == 0
 
+    def load_impact(self, impact_file):
+        '''
+        load the affected templates written by provision_templates(impact_file=...)
+        so only affected deployment files are processed
+        '''
+        with open(impact_file) as fd:
+            self.impact = json.load(fd)
+
+    def get_deployment_files(self, dir_or_file, affected_only=True):
+        '''
+        returns the deployment files in dir_or_file. If an impact is known
+        (see provision_templates) and affected_only is True, only files
+        referencing an affected template or changed since the impact's commit
+        are returned
+        '''
+        from git import exc
+
+        if os.path.isdir(dir_or_file):
+            files = [os.path.join(dir_or_file, f)
+                     for f in sorted(os.listdir(dir_or_file))
+                     if not f.startswith('.') and (f.endswith('.yaml') or f.endswith('.yml'))]
+        else:
+            files = [dir_or_file]
+        self.parse_deployment_files(files)
+
+        if not affected_only or not self.impact or not self.impact.get('since') or self.repo is None:
+            return files
+
+        try:
+            # git runs in git_root and lists the files relative to the top-level directory,
+            # so paths are compared resolved
+            root = self.repo.rev_parse('--show-toplevel')
+            changed = self.repo.diff('--name-only', self.impact['since'], 'HEAD', '--', os.path.abspath(dir_or_file))
+        except exc.GitCommandError as e:
+            logger.warning('Can\'t compute diff since commit {}: {}'.format(self.impact['since'], e))
+            return files
+        changed = set(os.path.realpath(os.path.join(root, f)) for f in changed.splitlines() if f)
+
+        affected = []
+        for f in files:
+            dep_info = self.parse_deployment_file(f)
+            if os.path.realpath(f) in changed or dep_info.template_name in self.impact['templates'] or \
+                    changed.intersection(os.path.realpath(s) for s in dep_info.get('shard_files', [])):
+                affected.append(f)
+            else:
+                logger.info('{} not affected by this change, skipping'.format(f))
+        return affected
+
+    @staticmethod
+    def _deployment_key(deployment_file):
+        st = os.stat(deployment_file)
+        return (os.path.realpath(deployment_file), st.st_mtime_ns, st.st_size)
+
     def parse_deployment_file(self, deployment_file):
         '''
         Parses a deployment file and returns the contents in a structure
         with all device params expanded (i.e. global params applied to each
-        device params dict)
+        device params dict). Results are kept until the file changes, so
+        files parsed for the impact filter aren't parsed again
         '''
-        logger.info('processing {}'.format(deployment_file))
-        with open(deployment_file) as fd:
-            result = yaml.safe_load(fd.read())
-
-        if not result or not isinstance(result, dict):
-            raise ValueError('{} does not look like a YAML file'.format(deployment_file))
+        key = self._deployment_key(deployment_file)
+        with self.init_lock:
+            result = self.deployments.get(key)
+        if result is not None:
+            return result
 
-        if 'template_name' not in result:
-            result['template_name'] = _basename(deployment_file)
+        logger.info('processing {}'.format(deployment_file))
+        result = parse_deployment_file(deployment_file, workers=int(self.config.parse_workers))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('parse_deployment_file() returns: {}'.format(result))
+        with self.init_lock:
+            self.deployments[key] = result
+        return result
 
-        # set up global vars for this deployment
-        if 'params' in result:
-            assert isinstance(result['params'], dict), \
-                'params in deployment file {} must be yaml dictionary'.format(deployment_file)
-            global_params = result['params']
-        else:
-            global_params = {}
-
-        # iterate through devices configured
-        for device, items in result['devices'].items():
-            if items is None:
-                # in case no params defined under device
-                result['devices'][device] = {}
-            result['devices'][device]['name'] = device
-
-            if items and 'params' in items:
-                # we can define a single var/value dict for device,
-                # or a list of var/value dicts in which case the template
-                # will be applied multiple times with different values
-                params = []
-                if isinstance(items['params'], dict):
-                    param_list = [items['params']]
-                elif isinstance(items['params'], list):
-                    param_list = items['params']
-                elif items['params'] is None:
-                    # allow to remove global params with an empty param list
-                    param_list = [{}]
-                else:
-                    raise ValueError('{} params need to be dict, list or None'.format(device))
-                # update the variable assignment per device
-                for i, p in enumerate(param_list):
-                    params.append(global_params.copy())
-                    params[i].update(p)
-            else:
-                params = [global_params]
-            result['devices'][device]['params'] = params
+    def parse_deployment_files(self, files):
+        '''
+        parses the deployment files not parsed yet in a process pool (if
+        parse_workers > 1), so parse_deployment_file() returns them right away
+        '''
+        workers = int(self.config.parse_workers)
+        keys = {}
+        for f in files:
+            key = self._deployment_key(f)
+            if key not in self.deployments:
+                keys[f] = key
+        if workers <= 1 or len(keys) <= 1:
+            return
 
-        logger.debug('parse_deployment_file() returns: {}'.format(result))
-        return AttrDict(result)
+        start = time.time()
+        with ProcessPoolExecutor(max_workers=min(workers, len(keys))) as pool:
+            results = list(pool.map(parse_deployment_file, keys))
+        with self.init_lock:
+            for f, result in zip(keys, results):
+                self.deployments[keys[f]] = result
+        logger.info('Parsed {} deployment files in {:.2f}s'.format(len(keys), time.time() - start))
 
     def _log_preview(self, msg, fd=None, facility='info'):
         getattr(logger, facility)(msg)
         if fd:
             fd.write(msg + '\n')
 
-    def preview_templates(self, dir_or_file, preview_file=None):
+    def preview_templates(self, dir_or_file, preview_file=None, local=False, result_json=None):
+        '''
+        preview the templates for all targets in the deployment files.
+        If local is True, Jinja templates are rendered from template_dir
+        instead of using DNAC's preview API (see LocalRenderer).
+        A summary including all validation errors is written to result_json
+        '''
+        from local_render import LocalRenderer
+
+        if local:
+            self.local_renderer = LocalRenderer(self.template_dir, self.get_template_langauge,
+                                                cache_dir=self.config.jinja_cache_dir)
 
         if preview_file:
             fd = open(preview_file, 'a+')
@@ -455,80 +1113,338 @@ class DNACTemplate(object):
             fd = None
 
         try:
-            rc = self.deploy_templates(dir_or_file, result_json=None, preview_fd=fd, preview=True)
+            summary = self._preview_all(self.get_deployment_files(dir_or_file), fd)
         finally:
             if fd:
                 fd.close()
 
-        return rc
+        if self.preview_mismatches:
+            logger.warning('{} local previews differ from DNAC\'s preview'.format(self.preview_mismatches))
+        logger.info('Previewed {} targets, {} with validation errors'.format(summary['targets'], summary['failed']))
+
+        if result_json:
+            logger.info('Writing results to {}'.format(result_json))
+            update_results_json(
+                filename=result_json,
+                message='Template preview',
+                stats=summary,
+                db=self.get_run_db())
+        return True
+
+    def _preview_targets(self, files):
+        '''
+        yields (template name, template id, target) for all targets of the
+        deployment files, template id is None if we're not connected
+        '''
+        for f in files:
+            dep_info = self.parse_deployment_file(f)
+            if self.dnac is None:
+                # local preview only
+                template_id = None
+            else:
+                template_id = self.retrieve_template_id_by_name(dep_info.template_name)
+                assert template_id, 'Can\'t retrieve template {} in project {}'.format(
+                    dep_info.template_name, self.template_project)
+                logger.debug('Using template {}/{}'.format(dep_info.template_name, template_id))
+            for t in dep_info.targets():
+                yield (dep_info.template_name, template_id, {'id': t.device, 'params': materialize(t.params)})
+
+    def _preview_all(self, files, preview_fd=None):
+        '''
+        preview all targets of the deployment files using preview_workers
+        threads, writing the results to preview_fd in the order of the targets.
+        Returns a summary with the validation errors of each target which failed
+        '''
+        summary = {'targets': 0, 'rendered': 0, 'failed': 0, 'validation_errors': []}
+
+        def _preview(job):
+            (template_name, template_id, target_info) = job
+            return self._preview_target(template_name, template_id, target_info['params'])
+
+        workers = max(1, int(self.config.preview_workers))
+        for (template_name, _, target_info), (cli_preview, errors) in ordered_map(
+                _preview, self._preview_targets(files), workers):
+            self._log_preview('# rendering template {} for device {}, params: {}'.format(
+                template_name, target_info['id'], target_info['params']),
+                preview_fd)
+            summary['targets'] += 1
+            if cli_preview is None:
+                msg = ''
+                for e in errors:
+                    msg += ':'.join(str(i) for i in e.values()) + "\n  "
+                self._log_preview('\nERROR: {}\n'.format(msg), preview_fd, facility='error')
+                summary['failed'] += 1
+                summary['validation_errors'].append({
+                    'template': template_name,
+                    'device': target_info['id'],
+                    'errors': [dict(e) for e in errors],
+                })
+            else:
+                self._log_preview('\n{}\n'.format(cli_preview), preview_fd)
+                summary['rendered'] += 1
+        return summary
+
+    def _preview_remote(self, template_id, params):
+        results = self.dnac.configuration_templates.preview_template(
+            templateId=template_id, params=params)
+        return (results.cliPreview, getattr(results, 'validationErrors', None) or [])
 
-    def deploy_templates(self, dir_or_file, result_json=None, preview_fd=None, preview=False):
+    def _preview_target(self, template_name, template_id, params):
+        '''
+        returns (cli_preview, validation_errors) for the template rendered with params.
+        Rendered locally if we have a local renderer (cross-checking a sample
+        against DNAC), otherwise by DNAC
+        '''
+        def _normalize(text):
+            return [l.strip() for l in (text or '').splitlines() if l.strip()]
+
+        if self.local_renderer is not None and self.local_renderer.can_render(template_name):
+            local = self.local_renderer.render(template_name, params)
+            if template_id is None or \
+                    random.uniform(0, 100) >= float(self.config.preview_sample_percent):
+                return local
+            remote = self._preview_remote(template_id, params)
+            if _normalize(local[0]) != _normalize(remote[0]):
+                logger.warning('Local preview of template {} differs from DNAC for params {}'.format(
+                    template_name, params))
+                with self.preview_lock:
+                    self.preview_mismatches += 1
+            return remote
+
+        if template_id is None:
+            return (None, [{'type': 'TEMPLATE_ERROR',
+                            'message': 'Template {} can\'t be rendered locally'.format(template_name)}])
+        return self._preview_remote(template_id, params)
+
+    def get_template_hash(self, template_name, template_id):
+        '''
+        returns a hash identifying the template version we deploy, covering
+        the content of the template and all templates it includes as
+        provisioned on DNAC (which might not match template_dir if the project
+        was provisioned from another checkout)
+        '''
+        from template_deps import find_referenced_templates
+
+        contents = {}
+        pending = [(template_name, template_id)]
+        while pending:
+            (name, tid) = pending.pop()
+            if name in contents:
+                continue
+            if tid is None:
+                # the include is missing on DNAC, so is its content
+                contents[name] = ''
+                continue
+            details = self.dnac.configuration_templates.get_template_details(tid)
+            contents[name] = details.templateContent or ''
+            pending.extend((r, self.retrieve_template_id_by_name(r))
+                           for r in find_referenced_templates(contents[name], details.language) if r not in contents)
+
+        h = hashlib.sha256()
+        for name in sorted(contents):
+            h.update(name.encode('utf-8') + b'\0' + contents[name].encode('utf-8') + b'\0')
+        return h.hexdigest()
+
+    def get_template_variables(self, template_name, template_id):
+        '''
+        returns (variables, required variables) of a template as extracted by
+        get_template_params() from template_dir (or from DNAC if the template
+        isn't found locally)
+        '''
+        from preflight import optional_variables
+
+        if template_name not in self.template_variables:
+            path = os.path.join(self.template_dir, template_name)
+            if os.path.isfile(path):
+                with open(path) as fd:
+                    content = fd.read()
+                language = self.get_template_langauge(content)
+            else:
+                details = self.dnac.configuration_templates.get_template_details(template_id)
+                content = details.templateContent or ''
+                language = details.language
+            variables = set(p['parameterName'] for p in self.get_template_params(content, language, self.template_dir))
+            required = variables - optional_variables(content, language, variables)
+            self.template_variables[template_name] = (variables, required)
+        return self.template_variables[template_name]
+
+    def get_inventory(self):
+        '''
+        returns the hostnames of DNAC's devices, None if they can't be retrieved
+        '''
+        from dnacentersdk import ApiError
+
+        try:
+            return self.get_metadata().device_names()
+        except ApiError as e:
+            logger.warning('Can\'t retrieve device inventory, device names are not checked: {}'.format(e))
+            return None
+
+    def _preflight(self, template_name, template_id, targets, report, deployment_results):
+        '''
+        yields the targets passing the pre-flight check, appending the
+        check result of every target to report
+        '''
+        from preflight import check_target
+
+        (variables, required) = self.get_template_variables(template_name, template_id)
+        inventory = self.get_inventory() if self.dnac is not None else None
+        for target_info in targets:
+            result = check_target(template_name, target_info['id'], target_info['params'],
+                                  required, variables, inventory)
+            report.append(result)
+            if result['status'] == 'OK':
+                yield target_info
+                continue
+            reasons = []
+            if result['missing_params']:
+                reasons.append('missing params {}'.format(', '.join(result['missing_params'])))
+            if result['unknown_device']:
+                reasons.append('device not found in DNAC inventory')
+            logger.error('Rejecting {} on device {}: {}'.format(template_name, target_info['id'], '; '.join(reasons)))
+            deployment_results['targets_rejected'] += 1
+            self._record_item('deploy', 'device', target_info['id'], 'REJECTED', detail=template_name)
+
+    def preflight_check(self, dir_or_file, report_file=None):
+        '''
+        checks all targets of the deployment files: the params need to provide
+        all required template variables, and the devices need to be known to
+        DNAC. Returns the per-target report (also written to report_file)
+        '''
+        report = []
+        results = {'targets_rejected': 0}
+        for f in self.get_deployment_files(dir_or_file):
+            dep_info = self.parse_deployment_file(f)
+            template_id = None
+            if self.dnac is not None:
+                template_id = self.retrieve_template_id_by_name(dep_info.template_name)
+            targets = ({'id': t.device, 'params': materialize(t.params)} for t in dep_info.targets())
+            for _ in self._preflight(dep_info.template_name, template_id, targets, report, results):
+                pass
+
+        logger.info('Pre-flight check: {} of {} targets rejected'.format(results['targets_rejected'], len(report)))
+        if report_file:
+            with open(report_file, 'w') as fd:
+                json.dump({'targets': len(report), 'rejected': results['targets_rejected'], 'results': report},
+                          fd, indent=2)
+        return report
+
+    @staticmethod
+    def _batch_targets(targets, batch_size):
+        '''
+        split targets into batches of up to batch_size targets, making sure
+        a device is only deployed once per batch. Batches are yielded as soon
+        as they are full, the remaining ones at the end
+        '''
+        # (targets, device ids) of the batches which aren't full yet
+        open_batches = []
+        for target_info in targets:
+            for i, (batch, ids) in enumerate(open_batches):
+                if target_info['id'] not in ids:
+                    break
+            else:
+                i = len(open_batches)
+                batch, ids = [], set()
+                open_batches.append((batch, ids))
+            batch.append(target_info)
+            ids.add(target_info['id'])
+            if len(batch) >= batch_size:
+                del open_batches[i]
+                yield batch
+        for batch, _ in open_batches:
+            yield batch
+
+    def _not_deployed(self, state, template_name, template_hash, targets, deployment_results):
+        '''
+        yields the targets not yet deployed with template_hash, counting the others
+        as skipped
+        '''
+        for target_info in targets:
+            if state.is_deployed(target_info['id'], template_name, template_hash, target_info['params']):
+                deployment_results['deployments_skipped'] += 1
+                self._record_item('deploy', 'device', target_info['id'], 'SKIPPED', detail=template_name)
+            else:
+                yield target_info
+
+    def deploy_templates(self, dir_or_file, result_json=None, preview_fd=None, preview=False, force=False):
         '''
         deploy the templates in template_dir based on yaml files
         in dir_or_file (or use a single file)
         If preview is True, just preview the template (no deployment)
+        If deploy_state_db is configured, targets successfully deployed with the
+        same template version and params are skipped, unless force is True.
+        The impact filter only applies to previews: a deployment failed or
+        skipped in an earlier pipeline wouldn't be retried otherwise, and the
+        deploy_state_db already skips the targets deployed before
         '''
+        files = self.get_deployment_files(dir_or_file, affected_only=preview)
+        if preview:
+            self._preview_all(files, preview_fd)
+            return True
 
         deployment_results = {
             'deployment_runs': 0,
             'devices_configured': 0,
             'deployment_failures': 0,
+            'deployments_skipped': 0,
+            'targets_rejected': 0,
         }
 
-        if os.path.isdir(dir_or_file):
-            files = [os.path.join(dir_or_file, f)
-                     for f in os.listdir(dir_or_file)
-                     if not f.startswith('.') and (f.endswith('.yaml') or f.endswith('.yml'))]
-        else:
-            files = [dir_or_file]
+        state = None
+        if self.config.deploy_state_db:
+            from deploy_state import DeploymentStateStore
 
-        for f in files:
+            # DNAC instances and projects don't share deployments, even if using the same file
+            state = DeploymentStateStore(self.config.deploy_state_db, scope='{}/{}'.format(
+                self.config.dnac.get('base_url'), self.template_project))
 
-            dep_info = self.parse_deployment_file(f)
-
-            template_id = self.retrieve_template_id_by_name(dep_info.template_name)
-            assert template_id, 'Can\'t retrieve template {} in project {}'.format(
-                dep_info.template_name, self.template_project)
-            logger.debug('Using template {}/{}'.format(dep_info.template_name, template_id))
-
-            all_targets = []
-            for device, items in dep_info.devices.items():
-                for p in items['params']:
-                    d = {'id': device, 'type': 'MANAGED_DEVICE_HOSTNAME', 'params': p}
-                    # d.update({'scope': 'RUNTIME'})        # earlier versions than 2.2.3.3 needed this
-                    all_targets.append(d)
-            logger.debug('Target Info collected: {}'.format(all_targets))
-
-            devices_configured = {}
-
-            for target_info in all_targets:
-
-                if preview:
-                    self._log_preview('# rendering template {} for device {}, params: {}'.format(
-                        dep_info.template_name, target_info['id'], target_info['params']),
-                        preview_fd)
-                    results = self.dnac.configuration_templates.preview_template(
-                        templateId=template_id, params=target_info['params'])
-                    if results.cliPreview is None:
-                        errors = getattr(results, 'validationErrors', [])
-                        msg = ''
-                        for e in errors:
-                            msg += ':'.join(str(i) for i in e.values()) + "\n  "
-                        self._log_preview('\nERROR: {}\n'.format(msg), preview_fd, facility='error')
-                    else:
-                        self._log_preview('\n{}\n'.format(results.cliPreview), preview_fd)
+        devices_configured = {}
+        # (template name, template hash, targets, start time, future) of deployments
+        # we still need to collect the status for
+        pending_deployments = []
+        completed_at = {}
 
-                else:
-                    logger.info('Deploying {} using params {} on device {}'.format(
-                        dep_info.template_name, target_info['params'], target_info['id']))
-                    logger.debug('Target Info: {}'.format(target_info))
+        def _completed(future):
+            completed_at[future] = time.time()
 
-                    deployment_results['deployment_runs'] += 1
-                    devices_configured[target_info['id']] = 1
+        try:
+            for f in files:
+
+                dep_info = self.parse_deployment_file(f)
+
+                template_id = self.retrieve_template_id_by_name(dep_info.template_name)
+                assert template_id, 'Can\'t retrieve template {} in project {}'.format(
+                    dep_info.template_name, self.template_project)
+                logger.debug('Using template {}/{}'.format(dep_info.template_name, template_id))
+
+                # targets are expanded into the dicts the API expects one at a time, when they're used
+                all_targets = ({'id': t.device, 'type': 'MANAGED_DEVICE_HOSTNAME', 'params': materialize(t.params)}
+                               for t in dep_info.targets())
+                # earlier versions than 2.2.3.3 needed 'scope': 'RUNTIME' in each target
+
+                template_hash = None
+                skipped = deployment_results['deployments_skipped']
+                if state is not None:
+                    template_hash = self.get_template_hash(dep_info.template_name, template_id)
+                    if not force:
+                        all_targets = self._not_deployed(state, dep_info.template_name, template_hash,
+                                                         all_targets, deployment_results)
+                if self.config.preflight_check:
+                    all_targets = self._preflight(dep_info.template_name, template_id, all_targets,
+                                                  [], deployment_results)
+
+                # batches are deployed while the following targets are still read
+                for batch in self._batch_targets(all_targets, int(self.config.deploy_batch_size)):
+                    for target_info in batch:
+                        logger.info('Deploying {} using params {} on device {}'.format(
+                            dep_info.template_name, target_info['params'], target_info['id']))
+                        deployment_results['deployment_runs'] += 1
+                        devices_configured[target_info['id']] = 1
+                    logger.debug('Target Info: {}'.format(batch))
 
                     results = self.dnac.configuration_templates.deploy_template(
                         forcePushTemplate=True, isComposite=False,
-                        templateId=template_id, targetInfo=[target_info])
+                        templateId=template_id, targetInfo=batch)
                     logger.debug('Deployment request result: {}'.format(results))
 
                     # results returns deployment id within a text blob (sic), so extract
@@ -544,34 +1460,68 @@ class DNACTemplate(object):
                         raise ValueError('Can\'t extract deployment id from API response {}'.format(
                             results.deploymentId))
 
-                    # check for status
-                    i = 0
-                    while i < 10:
-                        time.sleep(2)
-                        results = self.dnac.configuration_templates.get_template_deployment_status(
-                            deployment_id=deployment_id)
-                        logger.debug('deployment status: {}'.format(results))
-                        if results.status in ('IN_PROGRESS', 'INIT'):
-                            i += 1
-                            continue
-                        else:
-                            break
-                    logger.info('deployment status: {}'.format(results.status))
-
-                    if results.status != 'SUCCESS':
-                        logger.error('Deployment error on device {}:\n{}'.format(
-                            target_info['id'], results.devices[0].detailedStatusMessage))
+                    # check for status, larger batches take longer to complete
+                    deadline = float(self.config.deployment_poll_deadline) + \
+                        float(self.config.deployment_poll_deadline_per_device) * (len(batch) - 1)
+                    future = self.submit_deployment(deployment_id, deadline=deadline)
+                    future.add_done_callback(_completed)
+                    pending_deployments.append((dep_info.template_name, template_hash, batch, time.time(), future))
+
+                # targets are only checked against the deployment state while batching
+                skipped = deployment_results['deployments_skipped'] - skipped
+                if skipped:
+                    logger.info('Skipped {} targets of {} already deployed with the same template and params'.format(
+                        skipped, dep_info.template_name))
+
+            for template_name, template_hash, batch, start, future in pending_deployments:
+                (_, results) = future.result()
+                duration = completed_at.get(future, time.time()) - start
+                # attribute the result to each device of the deployment
+                devices = getattr(results, 'devices', None) or []
+                device_status = {getattr(d, 'name', None): d for d in devices}
+                for target_info in batch:
+                    device = device_status.get(target_info['id'])
+                    if device is None and len(batch) == 1 and devices:
+                        device = devices[0]
+                    if len(batch) == 1:
+                        status = getattr(device, 'status', None) or results.status
+                        detail = getattr(device, 'detailedStatusMessage', results.status)
+                    elif device is None:
+                        # the deployment's status might be another device's, so we don't know
+                        status = 'UNKNOWN'
+                        detail = 'no status reported for this device (deployment status {})'.format(results.status)
+                    else:
+                        status = getattr(device, 'status', None) or 'UNKNOWN'
+                        detail = getattr(device, 'detailedStatusMessage', status)
+                    logger.info('deployment status on device {}: {}'.format(target_info['id'], status))
+                    self._record_item('deploy', 'device', target_info['id'], status, duration, template_name)
+
+                    if status != 'SUCCESS':
+                        logger.error('Deployment error on device {}:\n{}'.format(target_info['id'], detail))
                         deployment_results['deployment_failures'] += 1
+                    elif state is not None:
+                        state.record(target_info['id'], template_name, template_hash, target_info['params'])
+        finally:
+            if state is not None:
+                state.close()
+
+        self.log_poll_stats()
 
-        if result_json and not preview:
+        if result_json:
             deployment_results['devices_configured'] = len(devices_configured)
             logger.info('Writing results to {}'.format(result_json))
             update_results_json(
                 filename=result_json,
                 message='Template deployment run',
-                stats=deployment_results)
+                stats=deployment_results,
+                db=self.get_run_db())
+            update_results_json(
+                filename=result_json,
+                message='Deployment API and git calls',
+                stats=self.get_metrics().summary(),
+                db=self.get_run_db())
 
-        return deployment_results['deployment_failures'] == 0
+        return deployment_results['deployment_failures'] == 0 and deployment_results['targets_rejected'] == 0
 
     def render_tests(self, dir_or_file, out_dir, template_dir=None):
         '''
@@ -579,6 +1529,8 @@ class DNACTemplate(object):
         Use the same params structure used to preview/apply templates,
         but render jinja2 templates kept in template_dir
         '''
+        from template_cache import get_environment
+
         if not template_dir:
             template_dir = self.test_template_dir
 
@@ -587,12 +1539,7 @@ class DNACTemplate(object):
         except FileExistsError:
             pass
 
-        if os.path.isdir(dir_or_file):
-            files = [os.path.join(dir_or_file, f)
-                     for f in os.listdir(dir_or_file)
-                     if not f.startswith('.') and (f.endswith('.yaml') or f.endswith('.yml'))]
-        else:
-            files = [dir_or_file]
+        files = self.get_deployment_files(dir_or_file)
 
         for f in files:
 
@@ -602,20 +1549,14 @@ class DNACTemplate(object):
                 logger.debug('no test_template referenced in {}, skipping'.format(f))
                 continue
 
-            template_file = os.path.join(template_dir, dep_info.test_template)
-            with open(template_file) as fd:
-                content = fd.read()
-
-            template = Environment(loader=FileSystemLoader(template_dir)).from_string(content)
+            template = get_environment(template_dir, cache_dir=self.config.jinja_cache_dir).get_template(
+                dep_info.test_template)
 
             # populate device list for Jinja2 rendering. As we might have multiple params
             # dicts per device (we can apply the same template multiple times with different params)
             # we append this device multiple times (each with different params) for Jinja so the
             # test template author doesn't have to worry about this
-            devices = []
-            for dev, items in dep_info.devices.items():
-                for p in items['params']:
-                    devices.append({'name': dev, 'params': p})
+            devices = [{'name': t.device, 'params': t.params} for t in dep_info.targets()]
 
             test_content = template.render(devices=devices)
             logger.debug('Rendering {} produced:\n{}'.format(dep_info.test_template, test_content))
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Measure provisioning, preview and deployment throughput with synthetic
+# templates and deployment files against a local fake DNAC (see fake_dnac.py),
+# optionally failing if throughput dropped compared to an earlier run.
+#
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+from DNACTemplate import DNACTemplate
+from fake_dnac import FakeDNAC, FakeDNACServer
+
+STAGES = ['provision', 'provision_unchanged', 'preview', 'deploy']
+
+TEMPLATE = '''interface Loopback{{ loopback_id }}
+ description {{ descr }}
+ ip address {{ ipv4 }} 255.255.255.255
+'''
+
+logger = logging.getLogger('benchmark.py')
+
+parser = argparse.ArgumentParser(description='Benchmark DNACTemplate against a local fake DNAC')
+parser.add_argument('--templates', type=int, default=1000, help='number of templates provisioned')
+parser.add_argument('--targets', type=int, default=10000, help='number of targets (device/template pairs) previewed and deployed')
+parser.add_argument('--deployments', type=int, default=100, help='number of deployment files the targets are spread over')
+parser.add_argument('--devices', type=int, default=1000, help='number of devices in the inventory')
+parser.add_argument('--stages', default=','.join(STAGES),
+                    help='comma-separated stages to run, out of {} (default: all)'.format(', '.join(STAGES)))
+parser.add_argument('--config', default=os.path.join(os.path.dirname(__file__), 'config.yaml'),
+                    help='config file providing the worker, batch and polling settings (default: config.yaml)')
+parser.add_argument('--rate_limit', type=float, default=0, help='rate_limit used instead of the config\'s (default: no limit)')
+parser.add_argument('--latency', type=float, default=0, help='seconds each request to the fake DNAC is delayed')
+parser.add_argument('--jitter', type=float, default=0, help='additional random delay of up to this many seconds')
+parser.add_argument('--failure_rate', type=float, default=0, help='fraction of requests failed with 503/Retry-After')
+parser.add_argument('--task_duration', type=float, default=0, help='seconds until DNAC tasks complete')
+parser.add_argument('--deploy_duration', type=float, default=0, help='seconds until deployments complete')
+parser.add_argument('--url', help='use the fake DNAC running at this url (i.e. fake_dnac.py, credentials admin/admin) instead of starting one')
+parser.add_argument('--results', help='save throughput results in json in this file')
+parser.add_argument('--baseline', help='results json of an earlier run to compare with')
+parser.add_argument('--tolerance', type=float, default=20, help='fail if a stage\'s throughput dropped by more than this many percent compared to --baseline')
+parser.add_argument('--keep', action='store_true', help='keep the generated work directory')
+parser.add_argument('--debug', action='store_true', help='print more debugging output')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING)
+logger.setLevel(logging.INFO)
+
+stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+unknown = set(stages) - set(STAGES)
+if unknown:
+    parser.error('unknown stages: {}'.format(', '.join(sorted(unknown))))
+
+
+def generate(work_dir):
+    '''
+    write templates, deployment files and the config to work_dir, returns
+    (template_dir, deploy_dir, config_file)
+    '''
+    template_dir = os.path.join(work_dir, 'templates')
+    deploy_dir = os.path.join(work_dir, 'deployment')
+    os.makedirs(template_dir)
+    os.makedirs(deploy_dir)
+
+    for i in range(args.templates):
+        with open(os.path.join(template_dir, 'bench-{:05d}'.format(i)), 'w') as fd:
+            fd.write(TEMPLATE)
+
+    deployments = max(1, min(args.deployments, args.templates, args.targets))
+    for i in range(deployments):
+        count = args.targets // deployments + (1 if i < args.targets % deployments else 0)
+        devices = {}
+        for j in range(count):
+            n = (i * count + j) % args.devices + 1
+            devices['device-{}'.format(n)] = {'params': {'ipv4': '10.{}.{}.{}'.format(n // 65536, n // 256 % 256, n % 256)}}
+        with open(os.path.join(deploy_dir, 'bench-{:05d}.yaml'.format(i)), 'w') as fd:
+            yaml.safe_dump({'template_name': 'bench-{:05d}'.format(i),
+                            'params': {'loopback_id': i, 'descr': 'benchmark {}'.format(i)},
+                            'devices': devices}, fd)
+
+    with open(args.config) as fd:
+        config = yaml.safe_load(fd)
+    config.update({
+        'dnac': {'base_url': base_url, 'version': '2.2.3.3', 'username': 'admin', 'password': 'admin', 'verify': False},
+        'template_project': 'BENCH',
+        'git_root': work_dir,
+        'commit_history_count': 0,
+        'show_diffs': False,
+        'preview_sample_percent': 0,
+        'rate_limit': args.rate_limit,
+        # everything we deploy is measured, and no state is shared with the pipeline
+        'deploy_state_db': None,
+        'results_db': None,
+        'metadata_cache_file': None,
+        'token_cache_file': None,
+        'metrics_file': None,
+        'provision_state_file': os.path.join(work_dir, '.provision-state.json'),
+        'jinja_cache_dir': os.path.join(work_dir, '.jinja-cache'),
+    })
+    config_file = os.path.join(work_dir, 'config.yaml')
+    with open(config_file, 'w') as fd:
+        yaml.safe_dump(config, fd)
+    return (template_dir, deploy_dir, config_file)
+
+
+def run_stage(stage):
+    '''
+    runs a stage with its own DNACTemplate (like the pipeline does), returns
+    (ok, number of items processed)
+    '''
+    dnac = DNACTemplate(config_file=config_file)
+    dnac.template_dir = template_dir
+    try:
+        if stage in ('provision', 'provision_unchanged'):
+            return (dnac.provision_templates(template_dir), args.templates)
+        if stage == 'preview':
+            return (dnac.preview_templates(deploy_dir, preview_file=os.path.join(work_dir, 'preview.txt')),
+                    args.targets)
+        return (dnac.deploy_templates(deploy_dir), args.targets)
+    finally:
+        dnac.close()
+
+
+server = None
+if args.url:
+    base_url = args.url
+else:
+    fake = FakeDNAC(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                    task_duration=args.task_duration, deploy_duration=args.deploy_duration,
+                    devices=['device-{}'.format(i) for i in range(1, args.devices + 1)])
+    server = FakeDNACServer(fake)
+    base_url = server.start()
+
+work_dir = tempfile.mkdtemp(prefix='dnac-benchmark-')
+results = {}
+failed = []
+try:
+    (template_dir, deploy_dir, config_file) = generate(work_dir)
+    logger.info('Generated {} templates and {} targets in {}, using DNAC at {}'.format(
+        args.templates, args.targets, work_dir, base_url))
+
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        requests = fake.request_count() if server else None
+        start = time.time()
+        (ok, items) = run_stage(stage)
+        duration = time.time() - start
+        results[stage] = {
+            'items': items,
+            'seconds': round(duration, 2),
+            'per_second': round(items / duration, 1) if duration else None,
+        }
+        if server:
+            results[stage]['requests'] = fake.request_count() - requests
+        if not ok:
+            failed.append(stage)
+        logger.info('{:<20}{:>7} items{:>9.2f}s{:>10.1f}/s{}'.format(
+            stage, items, duration, results[stage]['per_second'] or 0, '' if ok else '  FAILED'))
+finally:
+    if server:
+        server.stop()
+    if args.keep:
+        logger.info('Work directory kept in {}'.format(work_dir))
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if args.results:
+    with open(args.results, 'w') as fd:
+        fd.write(json.dumps({
+            'parameters': {k: getattr(args, k) for k in ('templates', 'targets', 'deployments', 'devices',
+                                                         'latency', 'jitter', 'failure_rate', 'task_duration',
+                                                         'deploy_duration', 'rate_limit')},
+            'stages': results}, indent=2) + '\n')
+
+if args.baseline:
+    with open(args.baseline) as fd:
+        baseline = json.load(fd)['stages']
+    for stage, result in results.items():
+        before = (baseline.get(stage) or {}).get('per_second')
+        if not before or not result['per_second']:
+            continue
+        change = (result['per_second'] - before) * 100.0 / before
+        logger.info('{:<20}{:>10.1f}/s -> {:.1f}/s ({:+.1f}%)'.format(stage, before, result['per_second'], change))
+        if change < -args.tolerance:
+            logger.error('Throughput of {} dropped by {:.1f}% (tolerance {}%)'.format(stage, -change, args.tolerance))
+            failed.append(stage)
+
+sys.exit(1 if failed else 0)
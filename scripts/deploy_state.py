@@ -0,0 +1,71 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def params_hash(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class DeploymentStateStore(object):
+    '''
+    persistent record of successful deployments, keyed by scope (i.e. DNAC
+    instance and project), device, template name, template version hash and
+    params hash, so unchanged targets don't need to be deployed again
+    '''
+
+    def __init__(self, filename, scope=''):
+        self.filename = filename
+        self.scope = scope
+        self.db = sqlite3.connect(filename)
+        # entries of the first version had no scope and hashed the local template files
+        self.db.execute('DROP TABLE IF EXISTS deployments')
+        self.db.execute('''
+            CREATE TABLE IF NOT EXISTS target_deployments (
+                scope TEXT NOT NULL,
+                device TEXT NOT NULL,
+                template TEXT NOT NULL,
+                template_hash TEXT NOT NULL,
+                params_hash TEXT NOT NULL,
+                deployed_at REAL NOT NULL,
+                PRIMARY KEY (scope, device, template, template_hash, params_hash)
+            )''')
+        self.db.commit()
+
+    def is_deployed(self, device, template, template_hash, params):
+        row = self.db.execute(
+            'SELECT 1 FROM target_deployments '
+            'WHERE scope=? AND device=? AND template=? AND template_hash=? AND params_hash=?',
+            (self.scope, device, template, template_hash, params_hash(params))).fetchone()
+        return row is not None
+
+    def record(self, device, template, template_hash, params):
+        with self.db:
+            # deployments of older template versions are no longer of interest
+            self.db.execute(
+                'DELETE FROM target_deployments WHERE scope=? AND device=? AND template=? AND template_hash!=?',
+                (self.scope, device, template, template_hash))
+            self.db.execute(
+                'INSERT OR REPLACE INTO target_deployments VALUES (?, ?, ?, ?, ?, ?)',
+                (self.scope, device, template, template_hash, params_hash(params), time.time()))
+
+    def close(self):
+        self.db.close()
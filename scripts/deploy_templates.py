@@ -12,6 +12,7 @@ parser.add_argument('--deploy_dir', required=True, help='directory or single fil
 parser.add_argument('--debug', action='store_true', help='print more debugging output')
 parser.add_argument('--config', help='config file to use')
 parser.add_argument('--results', help='save results in json in this file (default: no file is created)')
+parser.add_argument('--force', action='store_true', help='deploy all targets, even if already deployed with the same template version and params')
 args = parser.parse_args()
 
 if args.debug:
@@ -20,5 +21,8 @@ else:
     logging.basicConfig(level=logging.INFO)
 
 dnac = DNACTemplate(config_file=args.config)
-result = dnac.deploy_templates(args.deploy_dir, result_json=args.results)
+try:
+    result = dnac.deploy_templates(args.deploy_dir, result_json=args.results, force=args.force)
+finally:
+    dnac.close()
 sys.exit(0 if result else 1)
@@ -0,0 +1,178 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import glob
+import os
+from collections import ChainMap, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import yaml
+
+# use libyaml if available, it's a lot faster on large deployment files
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# a single application of a template: device name and its params
+Target = namedtuple('Target', ['device', 'params'])
+
+
+def load_yaml(stream):
+    return yaml.load(stream, Loader=YamlLoader)
+
+
+def materialize(params):
+    '''
+    returns params (possibly a ChainMap of device and global params) as plain
+    dict, global params first, just like a copy of the global params updated
+    with the device params
+    '''
+    if not isinstance(params, ChainMap):
+        return dict(params)
+    result = {}
+    for m in reversed(params.maps):
+        result.update(m)
+    return result
+
+
+class DeploymentInfo(dict):
+    '''
+    parsed deployment file. Top-level keys are accessible as attributes
+    (without converting nested values like AttrDict does)
+    '''
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def targets(self):
+        '''
+        lazily yields a Target for every time the template is applied
+        '''
+        for device, items in self['devices'].items():
+            for p in items['params']:
+                yield Target(device, p)
+
+
+def _normalize_devices(devices, filename):
+    '''
+    validates the device entries and turns their params into a list of
+    dicts (None if the device has no params)
+    '''
+    if not isinstance(devices, dict):
+        raise ValueError('devices in {} must be yaml dictionary'.format(filename))
+    for device, items in devices.items():
+        if items is None:
+            # in case no params defined under device
+            items = devices[device] = {}
+        items['name'] = device
+
+        if 'params' in items:
+            # we can define a single var/value dict for device,
+            # or a list of var/value dicts in which case the template
+            # will be applied multiple times with different values
+            if isinstance(items['params'], dict):
+                items['params'] = [items['params']]
+            elif isinstance(items['params'], list):
+                pass
+            elif items['params'] is None:
+                # allow to remove global params with an empty param list
+                items['params'] = [{}]
+            else:
+                raise ValueError('{} params need to be dict, list or None'.format(device))
+        else:
+            items['params'] = None
+    return devices
+
+
+def read_device_shard(filename):
+    '''
+    reads and validates a device shard file, i.e. a yaml file with a devices
+    dictionary structured like the one in a deployment file
+    '''
+    with open(filename) as fd:
+        data = load_yaml(fd)
+    if not data or not isinstance(data, dict) or 'devices' not in data:
+        raise ValueError('{} does not look like a device shard file'.format(filename))
+    return _normalize_devices(data['devices'], filename)
+
+
+def shard_files(deployment_file, patterns):
+    '''
+    returns the shard files matching patterns (a glob or list of globs,
+    relative to the deployment file's directory)
+    '''
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    if not isinstance(patterns, list):
+        raise ValueError('device_files in {} must be a string or list'.format(deployment_file))
+    base_dir = os.path.dirname(deployment_file)
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.join(base_dir, pattern)))
+        if not matches:
+            raise ValueError('device_files pattern {} in {} matches no file'.format(pattern, deployment_file))
+        files.extend(f for f in matches if f not in files)
+    return files
+
+
+def parse_deployment_file(deployment_file, workers=1):
+    '''
+    Parses a deployment file and returns a DeploymentInfo with device params
+    expanded (i.e. global params applied to each device params dict).
+    Device params are ChainMaps on top of the global params, so they are
+    not copied for each device.
+    Devices can also be pulled from shard files listed in device_files,
+    which are parsed by up to workers processes
+    '''
+    with open(deployment_file) as fd:
+        result = load_yaml(fd)
+
+    if not result or not isinstance(result, dict):
+        raise ValueError('{} does not look like a YAML file'.format(deployment_file))
+
+    if 'template_name' not in result:
+        result['template_name'] = os.path.splitext(os.path.split(deployment_file)[1])[0]
+
+    # set up global vars for this deployment
+    if 'params' in result:
+        assert isinstance(result['params'], dict), \
+            'params in deployment file {} must be yaml dictionary'.format(deployment_file)
+        global_params = result['params']
+    else:
+        global_params = {}
+
+    devices = _normalize_devices(result.get('devices') or {}, deployment_file)
+    if 'device_files' in result:
+        result['shard_files'] = shard_files(deployment_file, result['device_files'])
+        if workers > 1 and len(result['shard_files']) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                shards = list(pool.map(read_device_shard, result['shard_files']))
+        else:
+            shards = [read_device_shard(f) for f in result['shard_files']]
+        for filename, shard in zip(result['shard_files'], shards):
+            for device in shard:
+                if device in devices:
+                    raise ValueError('device {} in {} is already defined for {}'.format(
+                        device, filename, deployment_file))
+            devices.update(shard)
+    result['devices'] = devices
+
+    for items in devices.values():
+        if items['params'] is None:
+            items['params'] = [global_params]
+        else:
+            # device params take precedence over global params
+            items['params'] = [ChainMap(p, global_params) for p in items['params']]
+
+    return DeploymentInfo(result)
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+#
+# Local stand-in for the DNAC API endpoints used by DNACTemplate (auth,
+# template projects, templates, versioning, preview, deployment, tasks and
+# device inventory), keeping its state in memory. Used by benchmark.py, or
+# run it standalone and point config.yaml's dnac.base_url to it.
+#
+import argparse
+import base64
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+API = '/dna/intent/api/v1'
+
+
+class FakeDNAC(object):
+    '''
+    in-memory DNAC state. Each request is delayed by latency seconds (plus up
+    to jitter seconds), failure_rate of the requests are answered with
+    failure_status (503 is sent with Retry-After: 1), tasks complete after
+    task_duration seconds and deployments after deploy_duration seconds,
+    failing on deploy_failure_rate of the devices
+    '''
+
+    def __init__(self, username='admin', password='admin', latency=0, jitter=0, failure_rate=0,
+                 failure_status=503, task_duration=0, deploy_duration=0, deploy_failure_rate=0, devices=()):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.task_duration = task_duration
+        self.deploy_duration = deploy_duration
+        self.deploy_failure_rate = deploy_failure_rate
+        self.lock = threading.RLock()
+        self.tokens = set()
+        self.projects = {}
+        self.templates = {}
+        self.tasks = {}
+        self.deployments = {}
+        self.devices = list(devices)
+        # endpoint name -> number of requests
+        self.requests = {}
+        self.routes = [
+            ('GET', r'/task/(?P<task_id>[^/]+)', self.get_task),
+            ('GET', r'/network-device/(?P<start>\d+)/(?P<count>\d+)', self.get_devices),
+            ('GET', r'/template-programmer/project', self.get_projects),
+            ('POST', r'/template-programmer/project', self.create_project),
+            ('POST', r'/template-programmer/project/(?P<project_id>[^/]+)/template', self.create_template),
+            ('GET', r'/template-programmer/template', self.get_templates),
+            ('PUT', r'/template-programmer/template', self.update_template),
+            ('POST', r'/template-programmer/template/version', self.version_template),
+            ('PUT', r'/template-programmer/template/preview', self.preview_template),
+            ('POST', r'/template-programmer/template/deploy', self.deploy_template),
+            ('GET', r'/template-programmer/template/deploy/status/(?P<deployment_id>[^/]+)', self.get_deployment),
+            ('GET', r'/template-programmer/template/(?P<template_id>[^/]+)', self.get_template),
+            ('DELETE', r'/template-programmer/template/(?P<template_id>[^/]+)', self.delete_template),
+        ]
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def request_count(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    # helpers
+
+    def _task(self, data=None, error=None):
+        task_id = str(uuid.uuid4())
+        with self.lock:
+            self.tasks[task_id] = {'data': data, 'error': error, 'done': time.time() + self.task_duration}
+        return {'response': {'taskId': task_id, 'url': '{}/task/{}'.format(API, task_id)}, 'version': '1.0'}
+
+    def _template_summary(self, t):
+        return {
+            'name': t['name'],
+            'projectName': self.projects[t['projectId']]['name'],
+            'projectId': t['projectId'],
+            'templateId': t['id'],
+            'versionsInfo': t['versionsInfo'],
+            'composite': t['composite'],
+        }
+
+    # auth
+
+    def authenticate(self, authorization):
+        expected = base64.b64encode('{}:{}'.format(self.username, self.password).encode('utf-8')).decode('ascii')
+        if authorization != 'Basic {}'.format(expected):
+            return None
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens.add(token)
+        return token
+
+    def authorized(self, token):
+        with self.lock:
+            return token in self.tokens
+
+    # endpoints, called with (query, body, **path params), returning (status, response)
+
+    def get_task(self, query, body, task_id):
+        with self.lock:
+            task = self.tasks.get(task_id)
+        if task is None:
+            return (404, {'response': {'errorCode': 'NotFound', 'message': 'task not found'}})
+        response = {'id': task_id, 'isError': False, 'progress': 'In progress'}
+        if time.time() >= task['done']:
+            if task['error']:
+                response.update({'isError': True, 'failureReason': task['error'], 'progress': task['error']})
+            else:
+                response.update({'data': task['data'], 'progress': 'Successfully completed',
+                                 'endTime': int(time.time() * 1000)})
+        return (200, {'response': response, 'version': '1.0'})
+
+    def get_devices(self, query, body, start, count):
+        start = int(start)
+        devices = self.devices[start - 1:start - 1 + int(count)]
+        return (200, {'response': [{'hostname': d, 'id': str(uuid.uuid5(uuid.NAMESPACE_DNS, d)),
+                                    'reachabilityStatus': 'Reachable'} for d in devices],
+                      'version': '1.0'})
+
+    def get_projects(self, query, body):
+        with self.lock:
+            projects = list(self.projects.values())
+        name = query.get('name')
+        return (200, [{'name': p['name'], 'id': p['id'], 'templates': []}
+                      for p in projects if name is None or p['name'] == name])
+
+    def create_project(self, query, body):
+        project_id = str(uuid.uuid4())
+        with self.lock:
+            if any(p['name'] == body.get('name') for p in self.projects.values()):
+                return (200, self._task(error='Project with name {} already exists'.format(body.get('name'))))
+            self.projects[project_id] = {'name': body.get('name'), 'id': project_id}
+        return (202, self._task(project_id))
+
+    def create_template(self, query, body, project_id):
+        template_id = str(uuid.uuid4())
+        with self.lock:
+            if project_id not in self.projects:
+                return (404, {'response': {'errorCode': 'NotFound', 'message': 'project not found'}})
+            if any(t['name'] == body.get('name') and t['projectId'] == project_id
+                   for t in self.templates.values()):
+                return (200, self._task(error='Template with name {} already exists'.format(body.get('name'))))
+            template = dict(body, id=template_id, projectId=project_id, versionsInfo=[],
+                            composite=body.get('composite', False))
+            template['projectName'] = self.projects[project_id]['name']
+            self.templates[template_id] = template
+        return (202, self._task(template_id))
+
+    def get_templates(self, query, body):
+        project_id = query.get('projectId')
+        with self.lock:
+            return (200, [self._template_summary(t) for t in self.templates.values()
+                          if project_id is None or t['projectId'] == project_id])
+
+    def get_template(self, query, body, template_id):
+        with self.lock:
+            template = self.templates.get(template_id)
+        if template is None:
+            return (404, {'response': {'errorCode': 'NotFound', 'message': 'template not found'}})
+        return (200, template)
+
+    def update_template(self, query, body):
+        with self.lock:
+            template = self.templates.get(body.get('id'))
+            if template is None:
+                return (200, self._task(error='Template {} not found'.format(body.get('id'))))
+            template.update({k: v for k, v in body.items() if k not in ('id', 'projectId')})
+        return (202, self._task(template['id']))
+
+    def version_template(self, query, body):
+        with self.lock:
+            template = self.templates.get(body.get('templateId'))
+            if template is None:
+                return (200, self._task(error='Template {} not found'.format(body.get('templateId'))))
+            version = {'id': str(uuid.uuid4()), 'version': str(len(template['versionsInfo']) + 1),
+                       'versionComment': body.get('comments', ''), 'versionTime': int(time.time() * 1000),
+                       'author': self.username}
+            template['versionsInfo'].append(version)
+        return (202, self._task(version['id']))
+
+    def delete_template(self, query, body, template_id):
+        with self.lock:
+            if self.templates.pop(template_id, None) is None:
+                return (200, self._task(error='Template {} not found'.format(template_id)))
+        return (202, self._task(template_id))
+
+    def render(self, content, params):
+        '''
+        substitutes plain variable references ({{ var }}, $var, ${var}), returns
+        (text, names of variables without value)
+        '''
+        missing = []
+
+        def _value(m):
+            name = m.group('jinja') or m.group('velocity')
+            if name not in params:
+                missing.append(name)
+                return m.group(0)
+            return str(params[name])
+
+        text = re.sub(r'\{\{\s*(?P<jinja>[A-Za-z_][A-Za-z0-9_]*)\s*\}\}|\$!?\{?(?P<velocity>[A-Za-z][A-Za-z0-9_]*)\}?',
+                      _value, content or '')
+        return (text, missing)
+
+    def preview_template(self, query, body):
+        with self.lock:
+            template = self.templates.get(body.get('templateId'))
+        if template is None:
+            return (404, {'response': {'errorCode': 'NotFound', 'message': 'template not found'}})
+        (text, missing) = self.render(template.get('templateContent'), body.get('params') or {})
+        if missing:
+            return (200, {'templateId': template['id'], 'cliPreview': None, 'validationErrors': [
+                {'type': 'MISSING_PARAMETER', 'message': 'Parameter {} is not defined'.format(m)}
+                for m in sorted(set(missing))]})
+        return (200, {'templateId': template['id'], 'cliPreview': text, 'validationErrors': []})
+
+    def deploy_template(self, query, body):
+        template_id = body.get('templateId')
+        with self.lock:
+            template = self.templates.get(template_id)
+        if template is None:
+            return (404, {'response': {'errorCode': 'NotFound', 'message': 'template not found'}})
+        targets = body.get('targetInfo') or []
+        deployment_id = str(uuid.uuid4())
+        devices = []
+        for target in targets:
+            failed = target.get('id') not in self.devices or random.random() < self.deploy_failure_rate
+            devices.append({
+                'name': target.get('id'),
+                'status': 'FAILURE' if failed else 'SUCCESS',
+                'detailedStatusMessage': 'Device deployment failed' if failed else 'Provisioning success',
+            })
+        with self.lock:
+            self.deployments[deployment_id] = {
+                'templateId': template_id, 'templateName': template['name'], 'devices': devices,
+                'start': time.time(), 'done': time.time() + self.deploy_duration}
+        # sic, including the typo of the real thing
+        return (200, {
+            'deploymentId': 'Deployment of  Template: {}.ApplicableTargets: [{}]Template Deployemnt Id: {}'.format(
+                template_id, ', '.join(str(t.get('id')) for t in targets), deployment_id),
+            'startTime': '', 'endTime': '', 'duration': '0 seconds'})
+
+    def get_deployment(self, query, body, deployment_id):
+        with self.lock:
+            deployment = self.deployments.get(deployment_id)
+        if deployment is None:
+            return (404, {'response': {'errorCode': 'NotFound', 'message': 'deployment not found'}})
+        if time.time() < deployment['done']:
+            status = 'IN_PROGRESS'
+            devices = [dict(d, status='IN_PROGRESS', detailedStatusMessage='') for d in deployment['devices']]
+        else:
+            devices = deployment['devices']
+            status = 'SUCCESS' if all(d['status'] == 'SUCCESS' for d in devices) else 'FAILURE'
+        return (200, {'deploymentId': deployment_id, 'templateName': deployment['templateName'],
+                      'templateVersion': '', 'status': status, 'devices': devices,
+                      'startTime': '', 'endTime': '', 'duration': '{:.0f} seconds'.format(
+                          time.time() - deployment['start'])})
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, don't wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, response, headers=None):
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        dnac = self.server.dnac
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length) if length else b''
+
+        if dnac.latency or dnac.jitter:
+            time.sleep(dnac.latency + random.uniform(0, dnac.jitter))
+
+        if method == 'POST' and url.path == '/dna/system/api/v1/auth/token':
+            dnac.count('authenticate')
+            token = dnac.authenticate(self.headers.get('Authorization'))
+            if token is None:
+                return self._send(401, {'error': 'Authentication has failed. Please provide valid credentials.'})
+            return self._send(200, {'Token': token})
+
+        if not url.path.startswith(API):
+            return self._send(404, {'error': 'not found'})
+        path = url.path[len(API):]
+        for route_method, pattern, endpoint in dnac.routes:
+            m = re.match(pattern + '$', path)
+            if route_method == method and m:
+                break
+        else:
+            return self._send(404, {'response': {'errorCode': 'NotFound', 'message': 'no route for {}'.format(path)}})
+
+        dnac.count(endpoint.__name__)
+        if not dnac.authorized(self.headers.get('X-Auth-Token')):
+            return self._send(401, {'response': {'errorCode': 'Unauthorized', 'message': 'token invalid or expired'}})
+        if random.random() < dnac.failure_rate:
+            headers = {'Retry-After': '1'} if dnac.failure_status in (429, 503) else None
+            return self._send(dnac.failure_status, {'response': {'errorCode': 'Injected',
+                                                                 'message': 'injected failure'}}, headers)
+        try:
+            body = json.loads(raw.decode('utf-8')) if raw else {}
+        except ValueError:
+            return self._send(400, {'response': {'errorCode': 'BadRequest', 'message': 'invalid json'}})
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        (status, response) = endpoint(query, body, **m.groupdict())
+        self._send(status, response)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+class FakeDNACServer(ThreadingMixIn, HTTPServer):
+    '''
+    HTTP server for a FakeDNAC, serving requests on a thread each.
+    start() runs it in a background thread and returns its base url
+    '''
+    daemon_threads = True
+    # DNACTemplate's connection pool might open many connections at once
+    request_queue_size = 128
+
+    def __init__(self, dnac, host='127.0.0.1', port=0):
+        self.dnac = dnac
+        HTTPServer.__init__(self, (host, port), RequestHandler)
+        self.thread = None
+
+    def handle_error(self, request, client_address):
+        # clients closing kept-alive connections (i.e. after a retried response) aren't errors
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            logger.debug('connection from {} closed by client'.format(client_address))
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    @property
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the DNAC API')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--username', default='admin', help='username to accept')
+    parser.add_argument('--password', default='admin', help='password to accept')
+    parser.add_argument('--devices', type=int, default=1000, help='number of devices (device-1 ... device-N) in the inventory')
+    parser.add_argument('--latency', type=float, default=0, help='seconds each request is delayed')
+    parser.add_argument('--jitter', type=float, default=0, help='additional random delay of up to this many seconds')
+    parser.add_argument('--failure_rate', type=float, default=0, help='fraction of requests answered with --failure_status')
+    parser.add_argument('--failure_status', type=int, default=503, help='HTTP status of injected failures')
+    parser.add_argument('--task_duration', type=float, default=0, help='seconds until tasks complete')
+    parser.add_argument('--deploy_duration', type=float, default=0, help='seconds until deployments complete')
+    parser.add_argument('--deploy_failure_rate', type=float, default=0, help='fraction of devices failing deployment')
+    parser.add_argument('--debug', action='store_true', help='log every request')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    dnac = FakeDNAC(username=args.username, password=args.password, latency=args.latency, jitter=args.jitter,
+                    failure_rate=args.failure_rate, failure_status=args.failure_status,
+                    task_duration=args.task_duration, deploy_duration=args.deploy_duration,
+                    deploy_failure_rate=args.deploy_failure_rate,
+                    devices=['device-{}'.format(i) for i in range(1, args.devices + 1)])
+    server = FakeDNACServer(dnac, args.host, args.port)
+    logger.info('Fake DNAC listening on {}'.format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
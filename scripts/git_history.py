@@ -0,0 +1,111 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import logging
+import os
+import re
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# record/field separators used in the git log format strings
+RS = '\x1e'
+FS = '\x1f'
+
+
+class GitHistoryIndex(object):
+    '''
+    Commit log and last-change diff for all files below a directory,
+    retrieved with (at most) two git invocations instead of one or two
+    per file. Lookups are served from memory. Files are keyed by their
+    path relative to the repository's top-level directory
+    '''
+
+    def __init__(self, repo, path, commits_count=5, with_diffs=False):
+        self.root = os.path.realpath(repo.rev_parse('--show-toplevel'))
+        self.path = self._key(path)
+        self.commits_count = commits_count
+        # file name -> list of formatted commit log lines (newest first)
+        self.commit_logs = {}
+        # file name -> latest commit hash
+        self.last_commit = {}
+        # file name -> diff text of the latest commit
+        self.diffs = {}
+
+        self._load_log(repo)
+        if with_diffs:
+            self._load_diffs(repo)
+
+    def _key(self, filename):
+        return os.path.relpath(os.path.realpath(filename), self.root)
+
+    def covers(self, filename):
+        '''
+        True if the file's history was loaded, otherwise callers need to
+        query git for the file
+        '''
+        key = self._key(filename)
+        return os.path.dirname(key) == self.path and key in self.last_commit
+
+    def get_commit_log(self, filename, commits_count=5):
+        lines = self.commit_logs.get(self._key(filename), [])
+        return '\n'.join(lines[:commits_count]).replace("\\", "")
+
+    def get_file_diff(self, filename):
+        return self.diffs.get(self._key(filename), '')
+
+    def _load_log(self, repo):
+        # file names are listed relative to the top-level directory
+        log = repo.log('--pretty=format:{}%H{}"%ad | %s %d [%an]"'.format(RS, FS),
+                       '--date=short',
+                       '--name-only',
+                       '--', os.path.join(self.root, self.path))
+        for record in log.split(RS):
+            if not record.strip():
+                continue
+            lines = record.splitlines()
+            commit, entry = lines[0].split(FS, 1)
+            for f in lines[1:]:
+                if not f:
+                    continue
+                f = os.path.normpath(f)
+                self.last_commit.setdefault(f, commit)
+                if len(self.commit_logs.setdefault(f, [])) < self.commits_count:
+                    self.commit_logs[f].append(entry)
+        logger.debug('Loaded git history for {} files in {}'.format(len(self.last_commit), self.path))
+
+    def _load_diffs(self, repo):
+        commits = sorted(set(self.last_commit.values()))
+        if not commits:
+            return
+        output = repo.show('--pretty=format:{}%H'.format(RS),
+                           '-p',
+                           *commits,
+                           '--', os.path.join(self.root, self.path))
+        # split each commit's patch into per-file sections
+        sections = {}
+        for record in output.split(RS):
+            if not record.strip():
+                continue
+            commit, _, patch = record.partition('\n')
+            filename = None
+            for line in patch.splitlines(True):
+                m = re.match(r'diff --git a/(.+?) b/(.+)$', line)
+                if m:
+                    filename = os.path.normpath(m.group(2))
+                    sections[(commit, filename)] = ''
+                if filename:
+                    sections[(commit, filename)] += line
+
+        for f, commit in self.last_commit.items():
+            if (commit, f) in sections:
+                self.diffs[f] = '{}\n\n{}'.format(commit, sections[(commit, f)])
@@ -0,0 +1,51 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import time
+
+# attribute values returned as-is instead of being wrapped
+_PLAIN_TYPES = (str, bytes, int, float, bool, dict, list, tuple, set, type(None))
+
+
+class InstrumentedAPI(object):
+    '''
+    wraps an API object (i.e. DNACenterAPI) so every method call, including
+    calls on nested objects like dnac.configuration_templates, is timed and
+    reported to recorder(method, duration, ok), with method being the
+    dotted path (i.e. "configuration_templates.create_template")
+    '''
+
+    def __init__(self, target, recorder, prefix=''):
+        self._target = target
+        self._recorder = recorder
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        path = self._prefix + name
+        if isinstance(attr, _PLAIN_TYPES) or isinstance(attr, type):
+            return attr
+        if callable(attr):
+            recorder = self._recorder
+
+            def _call(*args, **kwargs):
+                start = time.time()
+                ok = False
+                try:
+                    result = attr(*args, **kwargs)
+                    ok = True
+                    return result
+                finally:
+                    recorder(path, time.time() - start, ok)
+            return _call
+        return InstrumentedAPI(attr, self._recorder, path + '.')
@@ -0,0 +1,129 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import logging
+import os
+import re
+import threading
+
+from jinja2 import BaseLoader, TemplateError, TemplateNotFound, Undefined
+
+from template_cache import get_environment
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# Velocity references or directives, templates without these are static
+VELOCITY_MARKUP = r'\$!?\{?[a-zA-Z]|#\{?(set|if|elseif|else|end|foreach|break|stop|parse|include|macro|evaluate|define)\b'
+
+
+class ProjectLoader(BaseLoader):
+    '''
+    loads templates from template_dir, resolving includes like DNAC does,
+    i.e. "__PROJECT__/foo" or "<project>/foo" refer to template "foo"
+    '''
+
+    def __init__(self, template_dir):
+        self.template_dir = template_dir
+
+    def get_source(self, environment, template):
+        path = os.path.join(self.template_dir, template.split('/')[-1])
+        if not os.path.isfile(path):
+            raise TemplateNotFound(template)
+        mtime = os.path.getmtime(path)
+        with open(path) as fd:
+            source = fd.read()
+        return source, path, lambda: os.path.getmtime(path) == mtime
+
+
+class _Render(threading.local):
+    # undefined variables seen while rendering in this thread
+    undefined = None
+
+
+_render = _Render()
+
+
+class RecordingUndefined(Undefined):
+    '''
+    renders as empty string (like DNAC), but records the variable
+    so it can be reported as validation error
+    '''
+    __slots__ = ()
+
+    def _record(self):
+        if _render.undefined is not None and self._undefined_name is not None:
+            _render.undefined.add(self._undefined_name)
+
+    def __str__(self):
+        self._record()
+        return ''
+
+    def __iter__(self):
+        self._record()
+        return iter(())
+
+    def _fail_with_undefined_error(self, *args, **kwargs):
+        self._record()
+        return super()._fail_with_undefined_error(*args, **kwargs)
+
+
+class LocalRenderer(object):
+    '''
+    render the Jinja templates in template_dir locally instead of using
+    DNAC's preview_template API. Results are returned in the same shape:
+    (cli_preview, validation_errors) with cli_preview None on errors
+    '''
+
+    def __init__(self, template_dir, get_language, cache_dir=None):
+        self.template_dir = template_dir
+        self.get_language = get_language
+        self.env = get_environment(template_dir, loader_class=ProjectLoader, cache_dir=cache_dir,
+                                   undefined=RecordingUndefined)
+        # template name -> None if we can't render it, otherwise the language
+        self.renderable = {}
+
+    def can_render(self, template_name):
+        '''
+        we can render Jinja templates and Velocity templates which don't use
+        any variables or directives (i.e. static config)
+        '''
+        if template_name not in self.renderable:
+            try:
+                source, _, _ = self.env.loader.get_source(self.env, template_name)
+            except TemplateNotFound:
+                language = None
+            else:
+                language = self.get_language(source)
+                if language != 'JINJA' and re.search(VELOCITY_MARKUP, source):
+                    language = None
+            self.renderable[template_name] = language
+        return self.renderable[template_name] is not None
+
+    def render(self, template_name, params):
+        if self.renderable.get(template_name) == 'VELOCITY':
+            source, _, _ = self.env.loader.get_source(self.env, template_name)
+            return (source, [])
+
+        _render.undefined = set()
+        try:
+            output = self.env.get_template(template_name).render(**params)
+        except TemplateError as e:
+            return (None, [{'type': 'TEMPLATE_ERROR', 'message': '{}: {}'.format(type(e).__name__, e)}])
+        finally:
+            undefined = _render.undefined
+            _render.undefined = None
+
+        if undefined:
+            return (None, [{'type': 'MISSING_PARAMETER', 'message': 'Variable "{}" is not defined'.format(v)}
+                           for v in sorted(undefined)])
+        return (output, [])
@@ -0,0 +1,142 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# devices retrieved per API call (DNAC's maximum)
+DEVICE_PAGE_SIZE = 500
+# bumped when the cache file format changes
+CACHE_VERSION = 2
+
+
+class MetadataIndex(object):
+    '''
+    index of DNAC projects, templates and device hostnames, listed once
+    and served from memory until invalidate() is called after a write.
+    If cache_file is given, the index is also shared with other processes
+    (i.e. pipeline stages) for up to ttl seconds.
+    '''
+
+    def __init__(self, dnac, cache_file=None, ttl=300, key=None):
+        self.dnac = dnac
+        self.cache_file = cache_file
+        self.ttl = ttl
+        # identifies the DNAC instance, so we don't use another one's cache file
+        self.key = key
+        self.lock = threading.Lock()
+        self.projects = None
+        # project id -> {template name: template id}
+        self.templates = {}
+        self.devices = None
+        # time the (oldest) data in the index was retrieved
+        self.retrieved_at = None
+        self._load()
+
+    def project_id(self, name):
+        with self.lock:
+            if self.projects is None:
+                logger.debug('Listing projects')
+                self.projects = {p.name: p.id for p in self.dnac.configuration_templates.get_projects()}
+                self._save()
+            return self.projects.get(name)
+
+    def _project_templates(self, project_id):
+        with self.lock:
+            if project_id not in self.templates:
+                logger.debug('Listing templates in project {}'.format(project_id))
+                self.templates[project_id] = {
+                    t.name: t.templateId for t in self.dnac.configuration_templates.gets_the_templates_available(
+                        project_id=project_id)}
+                self._save()
+            return self.templates[project_id]
+
+    def template_id(self, project_id, name):
+        return self._project_templates(project_id).get(name)
+
+    def device_names(self):
+        '''
+        returns the hostnames of the devices in DNAC's inventory
+        '''
+        with self.lock:
+            if self.devices is None:
+                logger.debug('Listing devices')
+                devices = []
+                start_index = 1
+                while True:
+                    response = self.dnac.devices.get_network_device_by_pagination_range(
+                        records_to_return=DEVICE_PAGE_SIZE, start_index=start_index).response
+                    # unreachable devices might not have a hostname
+                    devices.extend(d.hostname for d in response if d.get('hostname'))
+                    if len(response) < DEVICE_PAGE_SIZE:
+                        break
+                    start_index += DEVICE_PAGE_SIZE
+                self.devices = devices
+                self._save()
+            return set(self.devices)
+
+    def invalidate(self):
+        '''
+        forget everything, to be called after projects or templates are changed
+        '''
+        with self.lock:
+            self.projects = None
+            self.templates = {}
+            self.devices = None
+            self.retrieved_at = None
+            if self.cache_file:
+                try:
+                    os.remove(self.cache_file)
+                except FileNotFoundError:
+                    pass
+
+    def _load(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file) as fd:
+                data = json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return
+        if data.get('version') != CACHE_VERSION or data.get('key') != self.key or \
+                time.time() - data.get('retrieved_at', 0) > self.ttl:
+            logger.debug('Ignoring stale or foreign metadata cache {}'.format(self.cache_file))
+            return
+        self.projects = data.get('projects')
+        self.templates = data.get('templates', {})
+        self.devices = data.get('devices')
+        self.retrieved_at = data['retrieved_at']
+        logger.debug('Loaded metadata index from {}'.format(self.cache_file))
+
+    def _save(self):
+        if self.retrieved_at is None:
+            self.retrieved_at = time.time()
+        if not self.cache_file:
+            return
+        data = {
+            'version': CACHE_VERSION,
+            'key': self.key,
+            'retrieved_at': self.retrieved_at,
+            'projects': self.projects,
+            'templates': self.templates,
+            'devices': self.devices,
+        }
+        tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as fd:
+            json.dump(data, fd, default=str)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,148 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import os
+import threading
+
+# upper bounds (seconds) of the call duration histogram buckets
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = 'dnac_pipeline'
+COUNTER_HELP = {
+    'http_retries_total': 'HTTP requests retried after a 429/5xx response',
+    'rate_limit_wait_seconds_total': 'Time spent waiting for the rate limiter',
+    'polls_total': 'Status checks of DNAC tasks and deployments',
+    'poll_sleep_seconds_total': 'Time spent waiting between status checks',
+}
+
+
+def _labels(labels):
+    return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+
+    def observe(self, duration, ok):
+        self.count += 1
+        self.sum += duration
+        if not ok:
+            self.errors += 1
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+
+
+class Metrics(object):
+    '''
+    call duration histograms (per kind, i.e. "api" or "git", and method) and
+    counters, exported as Prometheus textfile or summarized for the results json
+    (thread-safe)
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (kind, method) -> Histogram
+        self.calls = {}
+        # (name, ((label, value), ...)) -> value
+        self.counters = {}
+
+    def observe(self, kind, method, duration, ok=True):
+        with self.lock:
+            h = self.calls.get((kind, method))
+            if h is None:
+                h = self.calls[(kind, method)] = Histogram()
+            h.observe(duration, ok)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] = value
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            calls = sorted(self.calls.items())
+            counters = sorted(self.counters.items())
+
+        name = '{}_call_duration_seconds'.format(PREFIX)
+        lines.append('# HELP {} Duration of DNAC API and git calls'.format(name))
+        lines.append('# TYPE {} histogram'.format(name))
+        for (kind, method), h in calls:
+            labels = {'kind': kind, 'method': method}
+            for bound, count in zip(BUCKETS, h.buckets):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, _labels(labels), bound, count))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, _labels(labels), h.count))
+            lines.append('{}_sum{{{}}} {:.6f}'.format(name, _labels(labels), h.sum))
+            lines.append('{}_count{{{}}} {}'.format(name, _labels(labels), h.count))
+
+        name = '{}_call_errors_total'.format(PREFIX)
+        lines.append('# HELP {} DNAC API and git calls which raised an exception'.format(name))
+        lines.append('# TYPE {} counter'.format(name))
+        for (kind, method), h in calls:
+            lines.append('{}{{{}}} {}'.format(name, _labels({'kind': kind, 'method': method}), h.errors))
+
+        described = set()
+        for (counter, labels), value in counters:
+            name = '{}_{}'.format(PREFIX, counter)
+            if counter not in described:
+                described.add(counter)
+                lines.append('# HELP {} {}'.format(name, COUNTER_HELP.get(counter, counter)))
+                lines.append('# TYPE {} counter'.format(name))
+            if labels:
+                lines.append('{}{{{}}} {}'.format(name, _labels(dict(labels)), round(value, 6)))
+            else:
+                lines.append('{} {}'.format(name, round(value, 6)))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename):
+        '''
+        writes the metrics for the node exporter's textfile collector
+        '''
+        tmp_file = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_file, 'w') as fd:
+            fd.write(self.to_prometheus())
+        os.replace(tmp_file, filename)
+
+    def summary(self):
+        '''
+        returns a flat summary: call counts, errors and time per kind, retries,
+        time spent waiting in polls and for the rate limiter, and the slowest
+        API method (by total time)
+        '''
+        result = {}
+        with self.lock:
+            calls = list(self.calls.items())
+            counters = list(self.counters.items())
+        for kind in sorted(set(k for (k, _), _ in calls)):
+            hs = [h for (k, _), h in calls if k == kind]
+            result['{}_calls'.format(kind)] = sum(h.count for h in hs)
+            result['{}_errors'.format(kind)] = sum(h.errors for h in hs)
+            result['{}_seconds'.format(kind)] = round(sum(h.sum for h in hs), 2)
+        for counter in ('http_retries_total', 'rate_limit_wait_seconds_total', 'polls_total', 'poll_sleep_seconds_total'):
+            value = sum(v for (name, _), v in counters if name == counter)
+            result[counter.replace('_total', '')] = round(value, 2)
+        api_calls = [(m, h) for (k, m), h in calls if k == 'api']
+        if api_calls:
+            method, h = max(api_calls, key=lambda c: c[1].sum)
+            result['slowest_api_method'] = '{} ({} calls, {:.2f}s)'.format(method, h.count, h.sum)
+        return result
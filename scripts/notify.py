@@ -61,7 +61,9 @@ class Notify(object):
                         message += '- {}: '.format(k)
                         print(k, v)
                         if isinstance(v, dict):
-                            message += ', '.join(['{}: {}'.format(k1, v1) for k1, v1 in v.items()])
+                            # nested lists (i.e. validation errors) are only counted, details are in the json file
+                            message += ', '.join(['{}: {}'.format(k1, len(v1) if isinstance(v1, list) else v1)
+                                                  for k1, v1 in v.items()])
                         elif isinstance(v, list):
                             message += ', '.join([str(i) for i in v])
                         else:
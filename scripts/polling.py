@@ -0,0 +1,213 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+class PollStats(object):
+    '''
+    completion latency statistics of polled tasks, number of checks and time
+    spent waiting between them (thread-safe)
+    '''
+
+    def __init__(self):
+        self.latencies = []
+        self.timeouts = 0
+        self.checks = 0
+        self.sleep = 0.0
+        self.lock = threading.Lock()
+
+    def add_check(self, sleep=0):
+        with self.lock:
+            self.checks += 1
+            self.sleep += sleep
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def add_timeout(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def summary(self):
+        with self.lock:
+            values = sorted(self.latencies)
+            timeouts = self.timeouts
+            checks = self.checks
+            sleep = self.sleep
+        result = {'completed': len(values), 'timeouts': timeouts, 'checks': checks, 'sleep': round(sleep, 2)}
+        if values:
+            result.update({
+                'min': round(values[0], 2),
+                'mean': round(sum(values) / len(values), 2),
+                'p50': round(values[len(values) // 2], 2),
+                'p95': round(values[min(len(values) - 1, int(len(values) * 0.95))], 2),
+                'max': round(values[-1], 2),
+            })
+        return result
+
+
+def jittered(delay):
+    return random.uniform(delay / 2, delay)
+
+
+def poll(check, deadline=60, initial_delay=0.5, max_delay=8, stats=None):
+    '''
+    call check() until it returns (True, value) or the deadline (in seconds)
+    has passed. The first check is done right away, after that we back off
+    exponentially (with jitter) from initial_delay up to max_delay.
+    Returns (done, value) with value as returned by the last check()
+    '''
+    start = time.time()
+    delay = initial_delay
+    while True:
+        done, value = check()
+        elapsed = time.time() - start
+        if done:
+            if stats is not None:
+                stats.add_check()
+                stats.add(elapsed)
+            return (True, value)
+
+        remaining = deadline - elapsed
+        if remaining <= 0:
+            logger.debug('giving up after {:.2f}s'.format(elapsed))
+            if stats is not None:
+                stats.add_check()
+                stats.add_timeout()
+            return (False, value)
+
+        sleep = min(remaining, jittered(delay))
+        if stats is not None:
+            stats.add_check(sleep)
+        time.sleep(sleep)
+        delay = min(delay * 2, max_delay)
+
+
+class AsyncPoller(object):
+    '''
+    polls many outstanding tasks on a single asyncio event loop running in a
+    background thread. All checks due are run together (on a small thread pool
+    as the SDK is blocking), each task backing off like poll() does.
+    submit() returns a concurrent.futures.Future resolving to (done, value)
+    '''
+
+    def __init__(self, initial_delay=0.5, max_delay=8, workers=8):
+        # asyncio is only needed with async_polling, so it isn't imported at startup
+        import asyncio
+
+        self.asyncio = asyncio
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.loop = self.asyncio.new_event_loop()
+        self.items = []
+        self.closed = False
+        self.wakeup = None
+        started = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def submit(self, check, deadline=60, stats=None):
+        item = {
+            'check': check,
+            'deadline': deadline,
+            'stats': stats,
+            'future': Future(),
+            'start': time.time(),
+            'due': 0,
+            'delay': self.initial_delay,
+        }
+        self.loop.call_soon_threadsafe(self._add, item)
+        return item['future']
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+        self.thread.join()
+        self.executor.shutdown(wait=True)
+
+    def _run(self, started):
+        self.asyncio.set_event_loop(self.loop)
+        self.wakeup = self.asyncio.Event()
+        started.set()
+        self.loop.run_until_complete(self._schedule())
+        self.loop.close()
+
+    def _add(self, item):
+        self.items.append(item)
+        self.wakeup.set()
+
+    async def _schedule(self):
+        while not self.closed:
+            now = time.time()
+            due = [i for i in self.items if i['due'] <= now]
+            if due:
+                results = await self.asyncio.gather(
+                    *[self.loop.run_in_executor(self.executor, i['check']) for i in due],
+                    return_exceptions=True)
+                for item, result in zip(due, results):
+                    self._update(item, result)
+                continue
+
+            timeout = min(i['due'] for i in self.items) - now if self.items else None
+            self.wakeup.clear()
+            try:
+                await self.asyncio.wait_for(self.wakeup.wait(), timeout)
+            except self.asyncio.TimeoutError:
+                pass
+
+        for item in self.items:
+            item['future'].cancel()
+
+    def _update(self, item, result):
+        if isinstance(result, Exception):
+            self.items.remove(item)
+            item['future'].set_exception(result)
+            return
+
+        done, value = result
+        elapsed = time.time() - item['start']
+        if done:
+            if item['stats'] is not None:
+                item['stats'].add_check()
+                item['stats'].add(elapsed)
+            self.items.remove(item)
+            item['future'].set_result((True, value))
+            return
+
+        remaining = item['deadline'] - elapsed
+        if remaining <= 0:
+            if item['stats'] is not None:
+                item['stats'].add_check()
+                item['stats'].add_timeout()
+            self.items.remove(item)
+            item['future'].set_result((False, value))
+            return
+
+        sleep = min(remaining, jittered(item['delay']))
+        if item['stats'] is not None:
+            item['stats'].add_check(sleep)
+        item['due'] = time.time() + sleep
+        item['delay'] = min(item['delay'] * 2, self.max_delay)
@@ -0,0 +1,96 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import re
+
+from jinja2 import TemplateSyntaxError, nodes
+
+from template_cache import get_environment
+
+# jinja filters accepting an undefined variable
+JINJA_TOLERANT_FILTERS = ('d', 'default', 'length', 'count', 'string')
+# jinja nodes passing on whether an undefined variable is tolerated
+JINJA_TRANSPARENT = (nodes.And, nodes.Or, nodes.Not, nodes.Compare, nodes.Operand)
+# velocity variables assigned in the template (#set, #foreach, #macro arguments)
+VELOCITY_LOCAL = r'#\{?(?:set|foreach)\}?\s*\(\s*\$!?\{?(\w+)'
+VELOCITY_MACRO = r'#\{?macro\}?\s*\(([^)]*)\)'
+VELOCITY_IF = r'#\{?(?:if|elseif)\}?\s*\(([^\n]*)'
+VELOCITY_REF = r'\$!?\{?(\w+)'
+
+
+def _jinja_checked(node, tolerant=False, checked=None):
+    '''
+    returns the names of the variables referenced where jinja tolerates them
+    being undefined: in if statement and conditional expression tests
+    (also combined with and/or/not or compared), tests like "is defined"
+    and filters like default or length
+    '''
+    if checked is None:
+        checked = set()
+    if isinstance(node, nodes.Name):
+        if tolerant and node.ctx == 'load':
+            checked.add(node.name)
+        return checked
+    if not isinstance(node, JINJA_TRANSPARENT):
+        tolerant = False
+    for field, child in node.iter_fields():
+        if isinstance(node, (nodes.If, nodes.CondExpr)) and field == 'test':
+            child_tolerant = True
+        elif isinstance(node, nodes.Test) and field == 'node':
+            child_tolerant = True
+        elif isinstance(node, nodes.Filter) and field == 'node':
+            child_tolerant = node.name in JINJA_TOLERANT_FILTERS
+        else:
+            child_tolerant = tolerant
+        for c in (child if isinstance(child, list) else [child]):
+            if isinstance(c, nodes.Node):
+                _jinja_checked(c, child_tolerant, checked)
+    return checked
+
+
+def optional_variables(content, language, variables):
+    '''
+    returns the variables a deployment doesn't need to provide: variables
+    checked for or defaulted (jinja), or set in the template, checked in
+    an #if or referenced quietly ($!var) (velocity)
+    '''
+    if language == 'JINJA':
+        try:
+            ast = get_environment().parse(content)
+        except TemplateSyntaxError:
+            return set()
+        return _jinja_checked(ast) & set(variables)
+
+    optional = set(re.findall(VELOCITY_LOCAL, content))
+    optional.update(re.findall(r'\$!\{?(\w+)', content))
+    for args in re.findall(VELOCITY_MACRO, content) + re.findall(VELOCITY_IF, content):
+        optional.update(re.findall(VELOCITY_REF, args))
+    return optional & set(variables)
+
+
+def check_target(template_name, device, params, required, variables, inventory=None):
+    '''
+    returns the pre-flight report of a single target: params missing for
+    the required variables, params the template doesn't use and whether
+    the device is found in the inventory (if known)
+    '''
+    missing = sorted(required - set(params))
+    unknown_device = inventory is not None and device not in inventory
+    return {
+        'template': template_name,
+        'device': device,
+        'status': 'REJECTED' if missing or unknown_device else 'OK',
+        'missing_params': missing,
+        'unused_params': sorted(set(params) - set(variables)),
+        'unknown_device': unknown_device,
+    }
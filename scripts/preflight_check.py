@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+#
+# Check deployment targets before deploying: params need to provide all
+# required template variables, and devices need to be known to DNAC
+#
+import argparse
+import logging
+import sys
+from DNACTemplate import DNACTemplate
+
+parser = argparse.ArgumentParser(description='Pre-flight check of deployment targets')
+parser.add_argument('--deploy_dir', required=True, help='directory or single file with yaml deployment config')
+parser.add_argument('--debug', action='store_true', help='print more debugging output')
+parser.add_argument('--config', help='config file to use')
+parser.add_argument('--report', help='write per-target report in json to this file')
+parser.add_argument('--impact_file', help='only process deployment files affected by the templates provisioned (json file written by provision_templates.py)')
+args = parser.parse_args()
+
+if args.debug:
+    logging.basicConfig(level=logging.DEBUG)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+dnac = DNACTemplate(config_file=args.config)
+try:
+    if args.impact_file:
+        dnac.load_impact(args.impact_file)
+    report = dnac.preflight_check(args.deploy_dir, report_file=args.report)
+finally:
+    dnac.close()
+sys.exit(0 if all(r['status'] == 'OK' for r in report) else 1)
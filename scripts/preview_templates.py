@@ -7,8 +7,12 @@ from DNACTemplate import DNACTemplate
 parser = argparse.ArgumentParser(description='Preview DNAC templates rendering result')
 parser.add_argument('--deploy_dir', required=True, help='directory or single file with yaml deployment config')
 parser.add_argument('--outfile', help='write preview result to this file')
+parser.add_argument('--results', help='save a summary including all validation errors in json in this file (default: no file is created)')
 parser.add_argument('--debug', action='store_true', help='print more debugging output')
 parser.add_argument('--config', help='config file to use')
+parser.add_argument('--impact_file', help='only process deployment files affected by the templates provisioned (json file written by provision_templates.py)')
+parser.add_argument('--local', action='store_true', help='render Jinja templates locally instead of using DNAC\'s preview API')
+parser.add_argument('--template_dir', help='template directory used for local rendering (default: dnac-templates/)')
 args = parser.parse_args()
 
 if args.debug:
@@ -16,6 +20,17 @@ if args.debug:
 else:
     logging.basicConfig(level=logging.INFO)
 
-dnac = DNACTemplate(config_file=args.config)
-result = dnac.preview_templates(args.deploy_dir, preview_file=args.outfile)
+dnac = DNACTemplate(config_file=args.config, connect=not args.local)
+try:
+    if args.local and float(dnac.config.preview_sample_percent) > 0:
+        # needed to cross-check local rendering
+        dnac.connect()
+    if args.template_dir:
+        dnac.template_dir = args.template_dir
+    if args.impact_file:
+        dnac.load_impact(args.impact_file)
+    result = dnac.preview_templates(args.deploy_dir, preview_file=args.outfile, local=args.local,
+                                    result_json=args.results)
+finally:
+    dnac.close()
 sys.exit(0 if result else 1)
@@ -11,6 +11,8 @@ parser.add_argument('--config', help='config file to use')
 parser.add_argument('--project', help='DNAC template project (default: taken from config)')
 parser.add_argument('--results', help='save results in json in this file (default: no file is created)')
 parser.add_argument('--nopurge', action="store_true", help='Don\'t delete templates found on DNAC which are not in the repo')
+parser.add_argument('--incremental', action="store_true", help='Only provision templates changed since the last successful run (based on git diff)')
+parser.add_argument('--impact_file', help='write templates affected by this run to this json file, used by deploy/preview (default: no file is created)')
 args = parser.parse_args()
 
 if args.debug:
@@ -19,5 +21,9 @@ else:
     logging.basicConfig(level=logging.INFO)
 
 dnac = DNACTemplate(config_file=args.config, project=args.project)
-result = dnac.provision_templates(args.template_dir, purge=not args.nopurge, result_json=args.results)
+try:
+    result = dnac.provision_templates(args.template_dir, purge=not args.nopurge, result_json=args.results,
+                                      incremental=args.incremental, impact_file=args.impact_file)
+finally:
+    dnac.close()
 sys.exit(0 if result else 1)
@@ -9,6 +9,7 @@ parser.add_argument('--deploy_dir', required=True, help='directory or single fil
 parser.add_argument('--out_dir', required=True, help='write tests to this directory')
 parser.add_argument('--debug', action='store_true', help='print more debugging output')
 parser.add_argument('--config', help='config file to use')
+parser.add_argument('--impact_file', help='only process deployment files affected by the templates provisioned (json file written by provision_templates.py)')
 args = parser.parse_args()
 
 if args.debug:
@@ -17,5 +18,10 @@ else:
     logging.basicConfig(level=logging.INFO)
 
 dnac = DNACTemplate(config_file=args.config, connect=False)
-result = dnac.render_tests(args.deploy_dir, args.out_dir)
+try:
+    if args.impact_file:
+        dnac.load_impact(args.impact_file)
+    result = dnac.render_tests(args.deploy_dir, args.out_dir)
+finally:
+    dnac.close()
 sys.exit(0 if result else 1)
@@ -0,0 +1,186 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+
+from transport import DNACAdapter
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+FIXTURE_VERSION = 1
+# response headers kept in fixtures (auth tokens are never recorded)
+RECORDED_HEADERS = ('Content-Type', 'Retry-After')
+# token handed to the SDK when replaying, so it doesn't authenticate
+REPLAY_TOKEN = 'replayed-session'
+
+
+def _open(filename, mode):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    return open(filename, mode, encoding='utf-8')
+
+
+def _body(data):
+    '''
+    request body as stored in fixtures: parsed json if possible, otherwise text
+    '''
+    if data is None:
+        return None
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+    try:
+        return json.loads(data)
+    except ValueError:
+        return data
+
+
+def load_fixture(filename):
+    with _open(filename, 'r') as fd:
+        fixture = json.load(fd)
+    if fixture.get('version') != FIXTURE_VERSION:
+        raise ValueError('{}: unsupported fixture version {}'.format(filename, fixture.get('version')))
+    return fixture
+
+
+class Recorder(object):
+    '''
+    records the requests sent to DNAC with their responses and timing,
+    to be saved as fixture file (thread-safe)
+    '''
+
+    def __init__(self):
+        self.start = time.time()
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def record(self, request, response, start, duration):
+        entry = {
+            'offset': round(start - self.start, 4),
+            'duration': round(duration, 4),
+            'method': request.method,
+            'path': request.path_url,
+            'request': _body(request.body),
+            'status': response.status_code,
+            'headers': {k: response.headers[k] for k in RECORDED_HEADERS if k in response.headers},
+            'response': response.content.decode('utf-8', 'replace'),
+        }
+        with self.lock:
+            self.entries.append(entry)
+
+    def save(self, filename, base_url=None):
+        with self.lock:
+            entries = sorted(self.entries, key=lambda e: e['offset'])
+        tmp_file = '{}.{}.tmp{}'.format(filename, os.getpid(), '.gz' if filename.endswith('.gz') else '')
+        with _open(tmp_file, 'w') as fd:
+            json.dump({
+                'version': FIXTURE_VERSION,
+                'recorded': datetime.utcnow().isoformat(),
+                'base_url': base_url,
+                'entries': entries,
+            }, fd, indent=1)
+        os.replace(tmp_file, filename)
+        return len(entries)
+
+
+class ReplayTokens(object):
+    '''
+    token cache (see token_cache.CachedAuthentication) which always has a
+    token, so the SDK doesn't authenticate when replaying
+    '''
+
+    def get(self, key):
+        return REPLAY_TOKEN
+
+    def put(self, key, token):
+        pass
+
+
+class ReplayAdapter(DNACAdapter):
+    '''
+    DNACAdapter serving responses from a fixture instead of DNAC. A request
+    gets the first unused recorded response to the same method and path,
+    preferring one recorded for the same request body. Once these are used up,
+    the last one is repeated (i.e. for additional status polls).
+    Responses are delayed by their recorded duration divided by speed
+    (0: no delay), so are retry waits
+    '''
+
+    def __init__(self, fixture, speed=1, **kwargs):
+        super(ReplayAdapter, self).__init__(**kwargs)
+        self.speed = float(speed)
+        self.replay_lock = threading.Lock()
+        # (method, path) -> [entry, ...] in recorded order
+        self.recorded = {}
+        for entry in fixture['entries']:
+            entry['used'] = False
+            self.recorded.setdefault((entry['method'], entry['path']), []).append(entry)
+        self.misses = 0
+
+    def match(self, request):
+        body = _body(request.body)
+        with self.replay_lock:
+            entries = self.recorded.get((request.method, request.path_url))
+            if not entries:
+                self.misses += 1
+                return None
+            unused = [e for e in entries if not e['used']]
+            entry = next((e for e in unused if e['request'] == body), unused[0] if unused else None)
+            if entry is None:
+                return entries[-1]
+            entry['used'] = True
+            return entry
+
+    def send_request(self, request, **kwargs):
+        entry = self.match(request)
+        response = Response()
+        response.request = request
+        response.url = request.url
+        response.encoding = 'utf-8'
+        # there's no raw (urllib3) response to read from or close
+        response._content_consumed = True
+        if entry is None:
+            logger.warning('No recorded response for {} {}'.format(request.method, request.path_url))
+            response.status_code = 404
+            response.reason = 'Not Recorded'
+            response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+            response._content = json.dumps({'response': {
+                'errorCode': 'NotRecorded', 'message': 'no recorded response'}}).encode('utf-8')
+            return response
+
+        if self.speed > 0:
+            time.sleep(entry['duration'] / self.speed)
+        response.status_code = entry['status']
+        response.reason = 'Replayed'
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['response'].encode('utf-8')
+        return response
+
+    def sleep(self, delay):
+        if self.speed > 0:
+            time.sleep(delay / self.speed)
+
+    def unused(self):
+        '''
+        returns the number of recorded responses not replayed
+        '''
+        with self.replay_lock:
+            return sum(1 for entries in self.recorded.values() for e in entries if not e['used'])
@@ -0,0 +1,131 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stages (
+    run_id TEXT NOT NULL,
+    results_file TEXT NOT NULL,
+    message TEXT NOT NULL,
+    stats TEXT NOT NULL,
+    recorded_at REAL NOT NULL,
+    PRIMARY KEY (run_id, results_file, message)
+);
+CREATE TABLE IF NOT EXISTS items (
+    run_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    duration REAL,
+    detail TEXT,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_run_stage ON items (run_id, stage, outcome);
+CREATE INDEX IF NOT EXISTS items_name ON items (name);
+CREATE TABLE IF NOT EXISTS api_calls (
+    run_id TEXT NOT NULL,
+    method TEXT NOT NULL,
+    duration REAL NOT NULL,
+    ok INTEGER NOT NULL,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS api_calls_run_method ON api_calls (run_id, method);
+'''
+
+
+class RunDatabase(object):
+    '''
+    SQLite database of pipeline run results: the summary stats of each stage
+    (as exported to the results json files), per-item (template, device)
+    outcomes and DNAC API call latencies.
+    Several threads and processes can write to the same database at a time.
+    '''
+
+    def __init__(self, filename, run_id=None):
+        self.filename = filename
+        # all jobs of a gitlab pipeline share the same run
+        self.run_id = run_id or os.environ.get('CI_PIPELINE_ID') or str(uuid.uuid4())
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.lock:
+            self.db.executescript(SCHEMA)
+
+    def _write(self, sql, params):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute(sql, params)
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def record_stage(self, results_file, message, stats):
+        self._write('INSERT OR REPLACE INTO stages VALUES (?, ?, ?, ?, ?)',
+                    (self.run_id, results_file, message, json.dumps(stats), time.time()))
+
+    def record_item(self, stage, kind, name, outcome, duration=None, detail=None):
+        self._write('INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (self.run_id, stage, kind, name, outcome, duration, detail, time.time()))
+
+    def record_api_call(self, method, duration, ok=True):
+        self._write('INSERT INTO api_calls VALUES (?, ?, ?, ?, ?)',
+                    (self.run_id, method, duration, 1 if ok else 0, time.time()))
+
+    def summary(self, results_file):
+        '''
+        returns the stage stats recorded for results_file in this run
+        '''
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT message, stats FROM stages WHERE run_id=? AND results_file=? ORDER BY recorded_at',
+                (self.run_id, results_file)).fetchall()
+        return {message: json.loads(stats) for message, stats in rows}
+
+    def items(self, stage=None, outcome=None):
+        sql = 'SELECT stage, kind, name, outcome, duration, detail FROM items WHERE run_id=?'
+        params = [self.run_id]
+        if stage:
+            sql += ' AND stage=?'
+            params.append(stage)
+        if outcome:
+            sql += ' AND outcome=?'
+            params.append(outcome)
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def api_latency(self):
+        '''
+        returns {method: {calls, errors, mean, max}} for this run
+        '''
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT method, COUNT(*), SUM(1 - ok), AVG(duration), MAX(duration) FROM api_calls '
+                'WHERE run_id=? GROUP BY method', (self.run_id,)).fetchall()
+        return {m: {'calls': c, 'errors': e, 'mean': round(a, 3), 'max': round(x, 3)}
+                for m, c, e, a, x in rows}
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+#
+# Run several pipeline stages in a single process, sharing the DNAC session,
+# the metadata index and the parsed deployment files. Writes the same
+# artifacts as the individual scripts.
+#
+import argparse
+import logging
+import sys
+import time
+
+from DNACTemplate import DNACTemplate
+from utils import update_results_json
+
+STAGES = ['provision', 'preflight', 'preview', 'deploy', 'render_tests']
+# later stages don't run if one of these fails (like in the CI pipeline)
+BLOCKING_STAGES = ['provision', 'deploy']
+
+logger = logging.getLogger('run_pipeline.py')
+
+parser = argparse.ArgumentParser(description='Run pipeline stages in a single process')
+parser.add_argument('--stages', default=','.join(STAGES),
+                    help='comma-separated stages to run, out of {} (default: all)'.format(', '.join(STAGES)))
+parser.add_argument('--template_dir', default='dnac-templates/', help='template directory')
+parser.add_argument('--deploy_dir', required=True, help='directory or single file with yaml deployment config')
+parser.add_argument('--debug', action='store_true', help='print more debugging output')
+parser.add_argument('--config', help='config file to use')
+parser.add_argument('--project', help='DNAC template project (default: taken from config)')
+parser.add_argument('--incremental', action='store_true', help='Only provision templates changed since the last successful run (based on git diff)')
+parser.add_argument('--force', action='store_true', help='deploy all targets, even if already deployed with the same template version and params')
+parser.add_argument('--local', action='store_true', help='render Jinja templates locally for the preview instead of using DNAC\'s preview API')
+parser.add_argument('--impact_file', default='template-impact.json', help='templates affected by provisioning (written by the provision stage, read if not run)')
+parser.add_argument('--provision_results', default='results-1-provision.json', help='provisioning results json file')
+parser.add_argument('--deploy_results', default='results-2-deploy.json', help='deployment results json file')
+parser.add_argument('--preflight_report', default='preflight-report.json', help='per-target pre-flight report json file')
+parser.add_argument('--preview_file', default='template-preview.txt', help='write preview result to this file')
+parser.add_argument('--preview_results', default='results-2-preview.json', help='preview summary json file')
+parser.add_argument('--out_dir', default='tests/deploy/', help='write rendered tests to this directory')
+parser.add_argument('--record', help='record the requests/responses exchanged with DNAC into this fixture file')
+parser.add_argument('--replay', help='serve DNAC responses from this fixture file instead of contacting DNAC')
+parser.add_argument('--replay_speed', type=float, help='replay this many times faster than recorded (0: no delays, default: taken from config)')
+parser.add_argument('--timing_results', help='save stage durations in json in this file (default: no file is created)')
+args = parser.parse_args()
+
+if args.debug:
+    logging.basicConfig(level=logging.DEBUG)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+unknown = set(stages) - set(STAGES)
+if unknown:
+    parser.error('unknown stages: {}'.format(', '.join(sorted(unknown))))
+
+dnac = DNACTemplate(config_file=args.config, project=args.project)
+dnac.template_dir = args.template_dir
+if args.record:
+    dnac.config.record_file = args.record
+if args.replay:
+    dnac.config.replay_file = args.replay
+if args.replay_speed is not None:
+    dnac.config.replay_speed = args.replay_speed
+if 'provision' not in stages and args.impact_file:
+    try:
+        dnac.load_impact(args.impact_file)
+    except FileNotFoundError:
+        logger.info('No impact file {}, processing all deployment files'.format(args.impact_file))
+
+
+def render_tests():
+    # tests are rendered for all deployments, not only the ones affected
+    impact = dnac.impact
+    dnac.impact = None
+    try:
+        return dnac.render_tests(args.deploy_dir, args.out_dir)
+    finally:
+        dnac.impact = impact
+
+
+run = {
+    'provision': lambda: dnac.provision_templates(
+        args.template_dir, result_json=args.provision_results, incremental=args.incremental,
+        impact_file=args.impact_file),
+    'preflight': lambda: all(r['status'] == 'OK' for r in dnac.preflight_check(
+        args.deploy_dir, report_file=args.preflight_report)),
+    'preview': lambda: dnac.preview_templates(args.deploy_dir, preview_file=args.preview_file, local=args.local,
+                                              result_json=args.preview_results),
+    'deploy': lambda: dnac.deploy_templates(args.deploy_dir, result_json=args.deploy_results, force=args.force),
+    'render_tests': render_tests,
+}
+
+timing = {}
+failed = []
+try:
+    for stage in STAGES:
+        if stage not in stages:
+            continue
+        logger.info('Running stage {}'.format(stage))
+        start = time.time()
+        try:
+            result = run[stage]()
+        except Exception:
+            logger.exception('Stage {} failed'.format(stage))
+            result = False
+        timing[stage] = round(time.time() - start, 2)
+        logger.info('Stage {} {} in {:.2f}s'.format(stage, 'completed' if result else 'FAILED', timing[stage]))
+        if not result:
+            failed.append(stage)
+            if stage in BLOCKING_STAGES:
+                break
+
+    for stage, duration in timing.items():
+        logger.info('{:<14}{:>8.2f}s'.format(stage, duration))
+    if args.timing_results:
+        update_results_json(filename=args.timing_results, message='Pipeline stage durations (s)',
+                            stats=timing, db=dnac.get_run_db())
+finally:
+    dnac.close()
+
+sys.exit(1 if failed else 0)
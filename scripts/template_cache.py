@@ -0,0 +1,80 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import hashlib
+import logging
+import os
+import threading
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, meta
+from jinja2.bccache import Bucket
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# shared Jinja environments, see get_environment()
+_environments = {}
+_lock = threading.Lock()
+
+# content hash -> undeclared variables
+_variables = {}
+
+
+def content_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+class ContentHashBytecodeCache(FileSystemBytecodeCache):
+    '''
+    on-disk Jinja bytecode cache keyed by template name and content hash
+    (instead of the template's file name), so it stays valid when the cache
+    directory is restored in a different CI job/checkout
+    '''
+
+    def get_bucket(self, environment, name, filename, source):
+        key = content_hash('{}\0{}'.format(name, source))
+        bucket = Bucket(environment, key, self.get_source_checksum(source))
+        self.load_bytecode(bucket)
+        return bucket
+
+
+def get_environment(template_dir=None, loader_class=FileSystemLoader, cache_dir=None, **options):
+    '''
+    returns a Jinja environment shared by all callers using the same
+    template_dir, loader and options, so templates (including imported
+    macros) are only compiled once per run. If cache_dir is given, compiled
+    templates are also cached on disk between runs.
+    '''
+    key = (loader_class, template_dir, cache_dir, tuple(sorted(options.items())))
+    with _lock:
+        if key not in _environments:
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+                options['bytecode_cache'] = ContentHashBytecodeCache(cache_dir)
+            _environments[key] = Environment(
+                loader=loader_class(template_dir) if template_dir else None,
+                # keep all templates used in this run
+                cache_size=-1,
+                **options)
+        return _environments[key]
+
+
+def find_undeclared_variables(content, env=None):
+    '''
+    returns the undeclared variables of a Jinja template, parsing each
+    distinct content only once
+    '''
+    key = content_hash(content)
+    if key not in _variables:
+        env = env or get_environment()
+        _variables[key] = meta.find_undeclared_variables(env.parse(content))
+    return _variables[key]
@@ -0,0 +1,138 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import logging
+import os
+import re
+
+from jinja2 import TemplateSyntaxError, meta
+
+from template_cache import get_environment
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+
+def find_referenced_templates(content, language):
+    '''
+    returns the set of template names referenced by a template via
+    include/import (Jinja) or #parse/#include (Velocity). Project
+    prefixes like "__PROJECT__/" are removed
+    '''
+    names = set()
+    if language == 'JINJA':
+        try:
+            ast = get_environment().parse(content)
+        except TemplateSyntaxError as e:
+            logger.warning('Can\'t parse template to find includes: {}'.format(e))
+            return names
+        # dynamic includes are returned as None, we can't resolve them
+        refs = [r for r in meta.find_referenced_templates(ast) if r]
+    else:
+        refs = re.findall(r'#(?:parse|include)\s*\(\s*["\']([^"\']+)["\']', content)
+
+    for r in refs:
+        names.add(r.split('/')[-1])
+    return names
+
+
+class TemplateGraph(object):
+    '''
+    dependency graph of the templates in a template directory, built from
+    their include/import statements
+    '''
+
+    def __init__(self, dependencies):
+        # template name -> set of template names it includes
+        self.deps = {k: set(v) for k, v in dependencies.items()}
+        # template name -> set of template names including it
+        self.rdeps = {}
+        for k, v in self.deps.items():
+            for d in v:
+                self.rdeps.setdefault(d, set()).add(k)
+
+    @classmethod
+    def from_dir(cls, template_dir, get_language):
+        dependencies = {}
+        for template_file in os.listdir(template_dir):
+            if template_file.startswith('.') or 'README.md' in template_file:
+                continue
+            with open(os.path.join(template_dir, template_file)) as fd:
+                content = fd.read()
+            dependencies[template_file] = find_referenced_templates(content, get_language(content))
+        return cls(dependencies)
+
+    def dependencies(self, name):
+        return self.deps.get(name, set())
+
+    def all_dependencies(self, name):
+        '''
+        returns all templates included by name, directly or indirectly
+        '''
+        result = set()
+        todo = [name]
+        while todo:
+            for d in self.deps.get(todo.pop(), set()):
+                if d not in result:
+                    result.add(d)
+                    todo.append(d)
+        return result
+
+    def dependents(self, name):
+        '''
+        returns all templates including name, directly or indirectly
+        '''
+        result = set()
+        todo = [name]
+        while todo:
+            for d in self.rdeps.get(todo.pop(), set()):
+                if d not in result:
+                    result.add(d)
+                    todo.append(d)
+        return result
+
+    def affected(self, names):
+        '''
+        returns names plus all templates depending on them
+        '''
+        result = set(names)
+        for n in names:
+            result |= self.dependents(n)
+        return result
+
+    def ordered(self, names):
+        '''
+        returns names sorted so dependencies come before the templates
+        including them. Dependencies not in names are ignored.
+        '''
+        names = list(names)
+        pending = set(names)
+        result = []
+        visiting = set()
+
+        def _visit(n):
+            if n not in pending:
+                return
+            if n in visiting:
+                logger.warning('Include loop detected involving template "{}"'.format(n))
+                return
+            visiting.add(n)
+            for d in sorted(self.dependencies(n)):
+                _visit(d)
+            visiting.discard(n)
+            if n in pending:
+                pending.discard(n)
+                result.append(n)
+
+        for n in names:
+            _visit(n)
+        return result
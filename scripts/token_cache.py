@@ -0,0 +1,129 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import hashlib
+import json
+import logging
+import os
+import stat
+import threading
+import time
+from collections import namedtuple
+
+from dnacentersdk import api
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# what the SDK's authentication_api() returns, as far as DNACenterAPI is concerned
+CachedToken = namedtuple('CachedToken', ['Token'])
+
+
+class TokenCache(object):
+    '''
+    DNAC auth tokens shared between processes (i.e. pipeline stages) in a
+    file only readable by its owner. Tokens are used for up to ttl seconds
+    (DNAC tokens expire after 60 minutes)
+    '''
+
+    def __init__(self, filename, ttl=3000):
+        self.filename = filename
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(base_url, user):
+        return hashlib.sha256('{}|{}'.format(base_url, user).encode('utf-8')).hexdigest()
+
+    def _read(self):
+        try:
+            mode = os.stat(self.filename).st_mode
+            if mode & (stat.S_IRWXG | stat.S_IRWXO):
+                logger.warning('Ignoring token cache {}, it is accessible by other users'.format(self.filename))
+                return {}
+            with open(self.filename) as fd:
+                return json.load(fd)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self._read().get(key)
+        if entry and time.time() - entry['issued'] < self.ttl:
+            return entry['token']
+        return None
+
+    def put(self, key, token):
+        with self.lock:
+            tokens = self._read()
+            tokens[key] = {'token': token, 'issued': time.time()}
+            # drop expired tokens of other DNACs/users
+            tokens = {k: v for k, v in tokens.items() if time.time() - v['issued'] < self.ttl}
+            tmp_file = '{}.{}.tmp'.format(self.filename, os.getpid())
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(tokens, f)
+            os.replace(tmp_file, self.filename)
+
+
+class CachedAuthentication(object):
+    '''
+    wraps the SDK's Authentication so the first token requested is taken
+    from the cache if available. Later requests (the SDK requests a new
+    token when DNAC returns 401) authenticate and update the cache
+    '''
+
+    def __init__(self, authentication, cache, key):
+        self._authentication = authentication
+        self._cache = cache
+        self._key = key
+        self._use_cache = True
+
+    def authentication_api(self, **kwargs):
+        if self._use_cache:
+            self._use_cache = False
+            token = self._cache.get(self._key)
+            if token:
+                logger.debug('Using cached DNAC token')
+                return CachedToken(token)
+        logger.debug('Authenticating to DNAC')
+        result = self._authentication.authentication_api(**kwargs)
+        self._cache.put(self._key, result.Token)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._authentication, name)
+
+
+class CachingDNACenterAPI(api.DNACenterAPI):
+    '''
+    DNACenterAPI reusing a still valid auth token from token_cache (if given)
+    instead of authenticating again
+    '''
+
+    def __init__(self, token_cache=None, **kwargs):
+        self._token_cache = token_cache
+        self._token_key = TokenCache.key(
+            kwargs.get('base_url'),
+            kwargs.get('username') or hashlib.sha256(str(kwargs.get('encoded_auth')).encode('utf-8')).hexdigest())
+        super(CachingDNACenterAPI, self).__init__(**kwargs)
+
+    @property
+    def authentication(self):
+        return self._authentication
+
+    @authentication.setter
+    def authentication(self, value):
+        # set by DNACenterAPI.__init__ before it requests the token
+        if self._token_cache is not None:
+            value = CachedAuthentication(value, self._token_cache, self._token_key)
+        self._authentication = value
@@ -0,0 +1,149 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import logging
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+# responses retried for every request, DNAC didn't process these
+RETRY_STATUS = (429, 503)
+# responses only retried for requests which can safely be repeated
+RETRY_STATUS_IDEMPOTENT = (500, 502, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class TokenBucket(object):
+    '''
+    rate limiter allowing rate requests per second on average, and bursts
+    of up to burst requests
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        takes a token, waiting until one is available. Returns the time waited
+        '''
+        waited = 0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+def retry_after(response):
+    '''
+    returns the delay in seconds requested by the Retry-After header, or None
+    '''
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class DNACAdapter(HTTPAdapter):
+    '''
+    requests transport adapter with a connection pool of pool_size
+    connections, an optional rate limit (requests per second) and retries
+    of 429/5xx responses, waiting as requested by Retry-After or backing
+    off exponentially. Retries and rate limit waits are counted in metrics
+    (a metrics.Metrics), and every request/response is passed to recorder
+    (a replay.Recorder), if given
+    '''
+
+    def __init__(self, pool_size=10, rate_limit=None, burst=None, retries=0, backoff=1, max_retry_wait=60,
+                 metrics=None, recorder=None):
+        self.bucket = TokenBucket(rate_limit, burst) if rate_limit else None
+        self.metrics = metrics
+        self.recorder = recorder
+        self.retries = retries
+        self.backoff = backoff
+        self.max_retry_wait = max_retry_wait
+        # block instead of opening (and discarding) extra connections if all are in use
+        super(DNACAdapter, self).__init__(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+
+    def _retry(self, request, response, attempt):
+        if attempt >= self.retries:
+            return False
+        if response.status_code in RETRY_STATUS:
+            return True
+        return response.status_code in RETRY_STATUS_IDEMPOTENT and request.method in IDEMPOTENT_METHODS
+
+    def send(self, request, **kwargs):
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                waited = self.bucket.acquire()
+                if waited and self.metrics is not None:
+                    self.metrics.inc('rate_limit_wait_seconds_total', waited)
+            start = time.time()
+            response = self.send_request(request, **kwargs)
+            if self.recorder is not None and not kwargs.get('stream'):
+                self.recorder.record(request, response, start, time.time() - start)
+            if not self._retry(request, response, attempt):
+                return response
+            delay = retry_after(response)
+            if delay is None:
+                delay = self.backoff * (2 ** attempt) * random.uniform(0.8, 1.2)
+            delay = min(delay, self.max_retry_wait)
+            attempt += 1
+            logger.warning('{} {} returned {}, retry {}/{} in {:.1f}s'.format(
+                request.method, request.path_url, response.status_code, attempt, self.retries, delay))
+            if self.metrics is not None:
+                self.metrics.inc('http_retries_total', status=response.status_code)
+            response.close()
+            self.sleep(delay)
+
+    def send_request(self, request, **kwargs):
+        '''
+        sends a single request (without rate limiting or retries)
+        '''
+        return super(DNACAdapter, self).send(request, **kwargs)
+
+    def sleep(self, delay):
+        time.sleep(delay)
+
+
+def mount_adapter(session, adapter):
+    '''
+    use adapter for all requests of a requests session
+    '''
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
@@ -13,6 +13,8 @@
 import json
 import os
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 from attrdict import AttrDict
@@ -49,9 +51,12 @@ def read_config(config_file):
     return AttrDict(replace_env_vars(attrs))
 
 
-def update_results_json(filename=None, message=None, stats={}):
+def update_results_json(filename=None, message=None, stats={}, db=None):
     '''
     Update results.json file, creating if it does not exist
+    If a RunDatabase is given, the stats are stored there and the run's
+    stats for this file are (re-)exported from the database, merged with
+    what the file holds already (i.e. written by another run id)
     '''
     if not filename:
         return
@@ -62,8 +67,45 @@ def update_results_json(filename=None, message=None, stats={}):
     except FileNotFoundError:
         results = {}
 
-    results[message] = stats
+    if db is not None:
+        db.record_stage(filename, message, stats)
+        results.update(db.summary(filename))
+    else:
+        results[message] = stats
 
-    with open(filename, 'w') as fd:
+    # write to a temp file first so readers never see a partially written file
+    tmp_file = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_file, 'w') as fd:
         fd.write(json.dumps(results, indent=2) + '\n')
+    os.replace(tmp_file, filename)
     return results
+
+
+def ordered_map(fn, items, workers=1, window=None):
+    '''
+    yields (item, fn(item)) for all items in their original order, calling fn
+    on a pool of workers threads. At most window items (default: 4 per worker)
+    are in flight, so results are streamed as they complete in order instead
+    of being collected first. Exceptions raised by fn are re-raised in order
+    '''
+    if workers <= 1:
+        for item in items:
+            yield (item, fn(item))
+        return
+
+    window = window or workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in items:
+                pending.append((item, executor.submit(fn, item)))
+                while pending and (len(pending) >= window or pending[0][1].done()):
+                    (item, future) = pending.popleft()
+                    yield (item, future.result())
+            while pending:
+                (item, future) = pending.popleft()
+                yield (item, future.result())
+        finally:
+            # don't start any more work if we bail out
+            for (_, future) in pending:
+                future.cancel()
@@ -2,59 +2,169 @@
 #
 # Validate template files and YAML deployment files
 #
+# Files are validated in a process pool. Files which validated successfully
+# before with the same content are skipped if validate_cache_file is configured
+#
+import hashlib
+import json
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
-from jinja2 import Environment
 from DNACTemplate import DNACTemplate
+from deployment import parse_deployment_file, shard_files
+from template_cache import get_environment
+from velocity import check_velocity
 
 DEPLOYMENT_DIRS = ['deployment/', 'deployment-preprod/']
 TEMPLATE_DIRS = ['dnac-templates/']
 
-errors = []
-
-dnac = DNACTemplate(connect=False)
-
-for d in DEPLOYMENT_DIRS:
-    for f in os.listdir(d):
-        if f.startswith('.') or not (f.endswith('.yaml') or f.endswith('.yml')):
-            continue
-
-        filename = os.path.join(d, f)
-        print('Examining {}'.format(filename))
-        try:
-            dnac.parse_deployment_file(filename)
-        except Exception as e:
-            msg = 'ERROR: YAML deployment validation failed for {}'.format(filename)
-            print(msg + ':\n' + str(e))
-            errors.append(msg)
-
-for d in TEMPLATE_DIRS:
-    for f in os.listdir(d):
-        if f.startswith('.'):
-            continue
-
-        filename = os.path.join(d, f)
-        print('Examining {}'.format(filename))
-        try:
-            with open(filename) as fd:
-                content = fd.read()
-
-            if '{' in content or '}' in content:
-                # check if jinja loads it
-                Environment().parse(content)
+# bump when validation gets stricter, so cached results are discarded
+CACHE_VERSION = 2
+# any of these makes us parse a template as Jinja (the language heuristic used
+# for provisioning would take a broken Jinja template for Velocity)
+JINJA_MARKERS = ('{{', '{%', '{#')
+
+
+def file_hash(filename):
+    with open(filename, 'rb') as fd:
+        return hashlib.sha256(fd.read()).hexdigest()
+
+
+def validate_deployment(filename):
+    '''
+    returns (error, {shard file: hash}, device_files) for a deployment file
+    '''
+    try:
+        dep_info = parse_deployment_file(filename)
+    except Exception as e:
+        return ('ERROR: YAML deployment validation failed for {}:\n{}'.format(filename, e), {}, None)
+    shards = {f: file_hash(f) for f in dep_info.get('shard_files', [])}
+    return (None, shards, dep_info.get('device_files'))
+
+
+def validation_language(content):
+    '''
+    templates containing Jinja delimiters must parse as Jinja, only
+    templates without any are checked as Velocity
+    '''
+    if any(m in content for m in JINJA_MARKERS):
+        return 'JINJA'
+    return 'VELOCITY'
+
+
+def validate_template(filename, content, language):
+    try:
+        if language == 'JINJA':
+            # check if jinja loads it
+            get_environment().parse(content)
+        else:
+            errors = check_velocity(content)
+            if errors:
+                raise ValueError('\n'.join(errors))
+    except Exception as e:
+        return 'ERROR: Template validation failed for {}:\n{}'.format(filename, e)
+    return None
+
+
+def load_cache(cache_file):
+    if not cache_file:
+        return {}
+    try:
+        with open(cache_file) as fd:
+            cache = json.load(fd)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache.get('files', {})
+
+
+def save_cache(cache_file, files):
+    if not cache_file:
+        return
+    tmp_file = '{}.tmp'.format(cache_file)
+    with open(tmp_file, 'w') as fd:
+        json.dump({'version': CACHE_VERSION, 'files': files}, fd, indent=2, sort_keys=True)
+    os.replace(tmp_file, cache_file)
+
+
+def is_cached(entry, digest, filename):
+    '''
+    checks if filename (and its device shard files) validated successfully
+    with the same content before
+    '''
+    if not entry or entry['hash'] != digest:
+        return False
+    try:
+        if entry.get('device_files') and \
+                set(shard_files(filename, entry['device_files'])) != set(entry['shards']):
+            return False
+        return all(file_hash(f) == h for f, h in entry.get('shards', {}).items())
+    except (OSError, ValueError):
+        return False
+
+
+def main():
+    start = time.time()
+    dnac = DNACTemplate(connect=False)
+    cache_file = dnac.config.validate_cache_file
+    cache = load_cache(cache_file)
+    validated = {}
+    errors = []
+    cached = 0
+
+    with ProcessPoolExecutor(max_workers=int(dnac.config.validate_workers) or None) as pool:
+        # filename -> (hash, future)
+        futures = {}
+        for d in DEPLOYMENT_DIRS:
+            for f in sorted(os.listdir(d)):
+                if f.startswith('.') or not (f.endswith('.yaml') or f.endswith('.yml')):
+                    continue
+                filename = os.path.join(d, f)
+                digest = file_hash(filename)
+                if is_cached(cache.get(filename), digest, filename):
+                    validated[filename] = cache[filename]
+                    cached += 1
+                    continue
+                print('Examining {}'.format(filename))
+                futures[filename] = (digest, pool.submit(validate_deployment, filename))
+
+        for d in TEMPLATE_DIRS:
+            for f in sorted(os.listdir(d)):
+                if f.startswith('.'):
+                    continue
+                filename = os.path.join(d, f)
+                with open(filename) as fd:
+                    content = fd.read()
+                language = validation_language(content)
+                digest = hashlib.sha256((language + content).encode('utf-8')).hexdigest()
+                entry = cache.get(filename)
+                if entry and entry['hash'] == digest:
+                    validated[filename] = entry
+                    cached += 1
+                    continue
+                print('Examining {} ({})'.format(filename, language))
+                futures[filename] = (digest, pool.submit(validate_template, filename, content, language))
+
+        for filename, (digest, future) in futures.items():
+            result = future.result()
+            if isinstance(result, tuple):
+                (error, shards, device_files) = result
+            else:
+                (error, shards, device_files) = (result, {}, None)
+            if error:
+                print(error)
+                errors.append(error)
             else:
-                # non-jinja not yet covered
-                pass
-        except Exception as e:
-            msg = 'ERROR: Template validation failed for {}'.format(filename)
-            print(msg + ':\n' + str(e))
-            errors.append(msg)
+                validated[filename] = {'hash': digest, 'shards': shards, 'device_files': device_files}
 
+    save_cache(cache_file, validated)
+    print('Validated {} files ({} unchanged) in {:.2f}s, {} errors'.format(
+        len(futures) + cached, cached, time.time() - start, len(errors)))
+    return 1 if len(errors) > 0 else 0
 
-if len(errors) > 0:
-    rc = 1
-else:
-    rc = 0
 
-sys.exit(rc)
+if __name__ == '__main__':
+    sys.exit(main())
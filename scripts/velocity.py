@@ -0,0 +1,135 @@
+#
+# Copyright (c) 2019 Cisco and/or its affiliates.
+# This software is licensed to you under the terms of the Cisco Sample
+# Code License, Version 1.0 (the "License"). You may obtain a copy of the
+# License at
+#                https://developer.cisco.com/docs/licenses
+# All use of the material herein must be in accordance with the terms of
+# the License. All rights not expressly granted by the License are
+# reserved. Unless required by applicable law or agreed to separately in
+# writing, software distributed under the License is distributed on an "AS
+# IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+# or implied.
+
+import re
+
+# directives opening a block closed by #end
+BLOCK_DIRECTIVES = ('if', 'foreach', 'macro', 'define')
+# directives which need arguments in parentheses
+ARG_DIRECTIVES = ('set', 'if', 'elseif', 'foreach', 'parse', 'include', 'macro', 'evaluate', 'define')
+
+TOKENS = re.compile(
+    r'\\[#$]'                                   # escaped directive or reference
+    r'|##[^\n]*'                                # line comment
+    r'|#\*(?:.*?\*#|.*)'                        # block comment (possibly unterminated)
+    r'|#\[\[(?:.*?\]\]#|.*)'                    # unparsed content (possibly unterminated)
+    r'|#\{?(?P<directive>set|if|elseif|else|end|foreach|break|stop|parse|include|macro|evaluate|define)\b\}?'
+    r'|\$!?\{',                                 # formal reference
+    re.S)
+
+SET_ARGS = re.compile(r'\s*\$!?\{?[A-Za-z][\w.\[\]"\'-]*\}?\s*=')
+FOREACH_ARGS = re.compile(r'\s*\$!?\{?[A-Za-z]\w*\}?\s+in\s+\S')
+
+
+def _closing(content, pos, opening, closing):
+    '''
+    returns the position after the bracket closing the one at pos,
+    skipping quoted strings, or None if it isn't closed
+    '''
+    depth = 0
+    quote = None
+    i = pos
+    while i < len(content):
+        c = content[i]
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c == opening:
+            depth += 1
+        elif c == closing:
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        elif c == '\n' and opening == '{':
+            # formal references don't span lines
+            return None
+        i += 1
+    return None
+
+
+def check_velocity(content):
+    '''
+    basic syntax check of a velocity template, returns a list of errors
+    (empty if none found)
+    '''
+    errors = []
+    # (directive, line) of open blocks
+    blocks = []
+
+    def line(pos):
+        return content.count('\n', 0, pos) + 1
+
+    pos = 0
+    while True:
+        m = TOKENS.search(content, pos)
+        if m is None:
+            break
+        token = m.group(0)
+        pos = m.end()
+
+        if token.startswith('#*') and not token.endswith('*#'):
+            errors.append('line {}: unterminated comment'.format(line(m.start())))
+            break
+        if token.startswith('#[[') and not token.endswith(']]#'):
+            errors.append('line {}: unterminated unparsed content'.format(line(m.start())))
+            break
+        if token.startswith('$'):
+            end = _closing(content, m.end() - 1, '{', '}')
+            if end is None:
+                errors.append('line {}: unterminated reference'.format(line(m.start())))
+            else:
+                pos = end
+            continue
+
+        directive = m.group('directive')
+        if directive is None:
+            continue
+        if directive in ARG_DIRECTIVES:
+            paren = re.compile(r'[ \t]*\(').match(content, pos)
+            if paren is None:
+                errors.append('line {}: #{} without arguments'.format(line(m.start()), directive))
+                continue
+            end = _closing(content, paren.end() - 1, '(', ')')
+            if end is None:
+                errors.append('line {}: unbalanced parentheses in #{}'.format(line(m.start()), directive))
+                continue
+            args = content[paren.end():end - 1]
+            pos = end
+            if directive == 'set' and not SET_ARGS.match(args):
+                errors.append('line {}: #set needs a $reference = value assignment'.format(line(m.start())))
+            elif directive == 'foreach' and not FOREACH_ARGS.match(args):
+                errors.append('line {}: #foreach needs a $item in list argument'.format(line(m.start())))
+            elif not args.strip():
+                errors.append('line {}: #{} with empty arguments'.format(line(m.start()), directive))
+
+        if directive in BLOCK_DIRECTIVES:
+            blocks.append((directive, line(m.start())))
+        elif directive in ('elseif', 'else'):
+            if not blocks or blocks[-1][0] not in ('if', 'else'):
+                errors.append('line {}: #{} without #if'.format(line(m.start()), directive))
+            elif blocks[-1][0] == 'else':
+                errors.append('line {}: #{} after #else'.format(line(m.start()), directive))
+            elif directive == 'else':
+                blocks[-1] = ('else', blocks[-1][1])
+        elif directive == 'end':
+            if not blocks:
+                errors.append('line {}: #end without open block'.format(line(m.start())))
+            else:
+                blocks.pop()
+
+    for directive, lineno in blocks:
+        errors.append('line {}: #{} not closed by #end'.format(
+            lineno, 'if' if directive == 'else' else directive))
+    return errors